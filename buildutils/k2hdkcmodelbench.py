@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# K2HDKC DBaaS based on Trove
+#
+# Copyright 2020 Yahoo Japan Corporation
+#
+# K2HDKC DBaaS is a Database as a Service compatible with Trove which
+# is DBaaS for OpenStack.
+# Using K2HR3 as backend and incorporating it into Trove to provide
+# DBaaS functionality. K2HDKC, K2HR3, CHMPX and K2HASH are components
+# provided as AntPickax.
+#
+# For the full copyright and license information, please view
+# the license file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Sun, Oct 18 2026
+# REVISION:
+#
+"""Benchmark of the k2hdkc extension models and their views.
+
+This compares the slotted User, Schema and UserAccess models of
+trove.extensions.k2hdkc.models with the dict-backed models and views
+which they replaced. Each row is a model construction plus its API view.
+The time is measured by timeit and the memory of the live models by
+tracemalloc.
+
+Example(on a host where trove is installed, e.g. by k2hdkcstack.sh):
+    python3 k2hdkcmodelbench.py --rows 200000 --memory-rows 10000
+    python3 k2hdkcmodelbench.py --trove-dir /opt/stack/trove --output r.json
+"""
+import argparse
+import gc
+import json
+import sys
+import timeit
+import tracemalloc
+
+DEFAULT_ROWS = 200000
+DEFAULT_MEMORY_ROWS = 10000
+DEFAULT_REPEAT = 5
+DATABASES_PER_USER = 3
+
+
+#
+# The dict-backed models and views before the slotted models
+#
+class DictUser(object):
+
+    def __init__(self, name, host, password, databases):
+        self.name = name
+        self.host = host
+        self.password = password
+        self.databases = databases
+
+
+class DictSchema(object):
+
+    def __init__(self, name, collate, character_set):
+        self.name = name
+        self.collate = collate
+        self.character_set = character_set
+
+
+def dict_user_view(user):
+    return {"user": {"name": user.name,
+                     "host": user.host,
+                     "databases": user.databases}}
+
+
+def dict_access_view(databases):
+    return {"databases": [{"name": db.name} for db in databases]}
+
+
+def load_models(trove_dir):
+    """Returns the k2hdkc extension models module."""
+    if trove_dir:
+        sys.path.insert(0, trove_dir)
+    from trove.extensions.k2hdkc import models
+    return models
+
+
+def make_cases(models):
+    """Returns {case name: (build function, view function)}."""
+    databases = [{'name': 'db%d' % index}
+                 for index in range(DATABASES_PER_USER)]
+
+    def _schemas(schema_class):
+        return [schema_class('db%d' % index, 'utf8_general_ci', 'utf8')
+                for index in range(DATABASES_PER_USER)]
+
+    return {
+        'user/dict': (
+            lambda n: DictUser('user%d' % n, '%', 'password', databases),
+            dict_user_view),
+        'user/slots': (
+            lambda n: models.User('user%d' % n, '%', 'password', databases),
+            lambda user: {"user": user.view_data()}),
+        'access/dict': (
+            lambda n: _schemas(DictSchema),
+            dict_access_view),
+        'access/slots': (
+            lambda n: models.UserAccess(_schemas(models.Schema)),
+            lambda access: access.view_data()),
+    }
+
+
+def measure_time(build, view, rows, repeat):
+    """Returns the best ns per row of build plus view."""
+    def _run():
+        for number in range(rows):
+            view(build(number))
+    best = min(timeit.repeat(_run, number=1, repeat=repeat))
+    return best * 1e9 / rows
+
+
+def measure_memory(build, rows):
+    """Returns the bytes per row of the live models."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        keep = [build(number) for number in range(rows)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del keep
+    return float(after - before) / rows
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=DEFAULT_ROWS,
+                        help='rows of the time measurement')
+    parser.add_argument('--memory-rows', type=int,
+                        default=DEFAULT_MEMORY_ROWS,
+                        help='rows of the memory measurement')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='repeat count of the time measurement, the '
+                             'best one is reported')
+    parser.add_argument('--trove-dir', default=None,
+                        help='top directory of trove if it is not installed')
+    parser.add_argument('--output', default=None,
+                        help='write the results to this json file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    models = load_models(args.trove_dir)
+
+    results = []
+    for name, (build, view) in sorted(make_cases(models).items()):
+        results.append({
+            'case': name,
+            'ns_per_row': measure_time(build, view, args.rows, args.repeat),
+            'bytes_per_row': measure_memory(build, args.memory_rows)})
+
+    print('%-14s %12s %14s' % ('case', 'ns/row', 'bytes/row'))
+    for result in results:
+        print('%-14s %12.0f %14.0f' % (result['case'], result['ns_per_row'],
+                                       result['bytes_per_row']))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: expandtab sw=4 ts=4 fdm=marker
+# vim<600: expandtab sw=4 ts=4
+#
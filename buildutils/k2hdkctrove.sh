@@ -78,6 +78,17 @@ K2HLINETOOL_CMD_FILE="/tmp/.${SCRIPTNAME}-${UNIX_TIME}.cmd"
 
 BACKUP_K2HDKC_CONFIG_FILE="${DATA_ANTPICKAX_DIR}/backup_k2hdkc.ini"
 
+#
+# Marker file of SERVICE OUT
+#
+# [NOTE]
+# ServiceOutNode creates this file, and CheckAndForceServiceIn does not
+# force SERVICE IN while it exists. So a node which is drained for
+# removal or reload does not join the ring again. ReloadNode and the
+# start mode remove it.
+#
+SERVICEOUT_MARKER_FILE="${ETC_ANTPICKAX_DIR}/k2hdkc-serviceout"
+
 #
 # Variables for waiting
 #
@@ -972,9 +983,9 @@ GetConfigValue()
 }
 
 #
-# Stop datadase and Unregister
+# Service out this node
 #
-StopDatabaseAndUnregister()
+ServiceOutNode()
 {
 	#
 	# Get CHMPX node information
@@ -992,6 +1003,13 @@ StopDatabaseAndUnregister()
 		#
 		NODE_NAME="${HOSTNAME_PART}:${CTLPORT_PART}:${CUK_PART}::"
 
+		#
+		# Keep this node SERVICE OUT in the main loop
+		#
+		if ! touch "${SERVICEOUT_MARKER_FILE}" >/dev/null 2>&1; then
+			PRNWARN "Could not create ${SERVICEOUT_MARKER_FILE}, this node may be forced to SERVICE IN."
+		fi
+
 		#
 		# Create chmpxlinetool command file.
 		#
@@ -1005,11 +1023,30 @@ StopDatabaseAndUnregister()
 		# Service Out this node
 		#
 		if ! chmpxlinetool -conf "${K2HDKC_CONFIG_FILE}" -run "${CHMPXLINETOOL_CMDFILE}" >/dev/null 2>&1; then
-			PRNWARN "Failed to run serviceout this node(${NODE_NAME}), but continue..."
+			PRNWARN "Failed to run serviceout this node(${NODE_NAME})."
+			rm -f "${CHMPXLINETOOL_CMDFILE}"
+			rm -f "${SERVICEOUT_MARKER_FILE}"
+			return 1
 		fi
 		rm -f "${CHMPXLINETOOL_CMDFILE}"
 	else
 		PRNWARN "It looks like chmpx hasn't been run successfully on this node yet."
+		return 1
+	fi
+
+	return 0
+}
+
+#
+# Stop datadase and Unregister
+#
+StopDatabaseAndUnregister()
+{
+	#
+	# Do service out
+	#
+	if ! ServiceOutNode; then
+		PRNWARN "Failed to service out this node, but continue..."
 	fi
 
 	#
@@ -1112,7 +1149,11 @@ RestoreFromArchive()
 	#
 	# Check Archive file
 	#
-	if [ ! -f "${K2HDKC_AR_FILE}" ]; then
+	# [NOTE]
+	# The archive file may be a named pipe when the backup driver streams
+	# the archive from the object storage directly.
+	#
+	if [ ! -f "${K2HDKC_AR_FILE}" ] && [ ! -p "${K2HDKC_AR_FILE}" ]; then
 		PRNERR "Not found ${K2HDKC_AR_FILE} archive file.(In this case, if you create a backup file that contains empty data, the extracted file(k2ar) may be empty.)"
 		return 1
 	fi
@@ -1225,14 +1266,85 @@ RestoreFromArchive()
 	return 0
 }
 
+#
+# Reload CHMPX with new parameters without stopping this container
+#
+# Input:	OPT_RELOAD_PARAMS	"<name>=<value>" list of changed parameters
+#
+# [NOTE]
+# The caller does service out this node and waits for the merging before
+# this. This function registers this node again with the new parameters,
+# and stops the CHMPX and K2HDKC processes. The main loop of the start
+# mode launches them again with the new k2hdkc.ini and does SERVICE IN.
+#
+ReloadNode()
+{
+	#
+	# Unregister with current parameters
+	#
+	if ! UnregisterNode; then
+		PRNWARN "Failed to unregister this node, but continue..."
+	fi
+
+	for _RELOAD_PARAM in ${OPT_RELOAD_PARAMS}; do
+		_RELOAD_NAME=$(echo "${_RELOAD_PARAM}" | sed -e 's|=.*$||g')
+		_RELOAD_VALUE=$(echo "${_RELOAD_PARAM}" | sed -e 's|^[^=]*=||g')
+
+		if [ "${_RELOAD_NAME}" != "${PARAM_NAME_CLUSTER_NAME}" ]		&& \
+		   [ "${_RELOAD_NAME}" != "${PARAM_NAME_CHMPX_SERVER_PORT}" ]	&& \
+		   [ "${_RELOAD_NAME}" != "${PARAM_NAME_CHMPX_SERVER_CTLPORT}" ]	&& \
+		   [ "${_RELOAD_NAME}" != "${PARAM_NAME_CHMPX_SLAVE_CTLPORT}" ]	; then
+
+			PRNERR "${_RELOAD_NAME} parameter can not be reloaded."
+			return 1
+		fi
+		if [ -z "${_RELOAD_VALUE}" ]; then
+			PRNERR "${_RELOAD_NAME} parameter value is empty."
+			return 1
+		fi
+		if ! (printf "%s" "${_RELOAD_VALUE}" > "${ETC_ANTPICKAX_DIR}/${_RELOAD_NAME}") 2>/dev/null; then
+			PRNERR "Could not write ${_RELOAD_NAME} parameter value(${_RELOAD_VALUE}) to ${ETC_ANTPICKAX_DIR}/${_RELOAD_NAME}."
+			return 1
+		fi
+	done
+
+	#
+	# Register Node with new parameters
+	#
+	if ! RegisterNode; then
+		return 1
+	fi
+
+	#
+	# The main loop does SERVICE IN again after launching the processes
+	#
+	rm -f "${SERVICEOUT_MARKER_FILE}"
+
+	#
+	# Stop processes, the main loop launches them again
+	#
+	if ! /usr/libexec/k2hdkc-service-helper stop >/dev/null 2>&1; then
+		PRNWARN "Failed to stop k2hdkc, but continue..."
+	fi
+	if ! /usr/libexec/chmpx-service-helper stop >/dev/null 2>&1; then
+		PRNWARN "Failed to stop chmpx, but continue..."
+	fi
+
+	return 0
+}
+
 #
 # Check and Force SERVICE IN
 #
 # [NOTE]
 # If the status is [SERVICE OUT][UP][n/a][Nothing][NoSuspend], force SERVICE IN.
+# But this node is kept SERVICE OUT while SERVICEOUT_MARKER_FILE exists.
 #
 CheckAndForceServiceIn()
 {
+	if [ -f "${SERVICEOUT_MARKER_FILE}" ]; then
+		return 0
+	fi
 	if chmpxstatus -conf /etc/antpickax/k2hdkc.ini -self | grep -q '\[SERVICE OUT]\.*\[UP\].*\[n/a\].*\[Nothing\].*\[NoSuspend\]'; then
 		#
 		# This node status it SERVICE OUT, so do SERVICE IN
@@ -1293,13 +1405,16 @@ Usage()
 {
 	echo ""
 	echo "Usage: ${SCRIPTNAME} --help(-h)"
-	echo "       ${SCRIPTNAME} [ start(s) | stop(a) ]"
+	echo "       ${SCRIPTNAME} [ start(s) | stop(a) | serviceout(o) ]"
+	echo "       ${SCRIPTNAME} reload(l) <name>=<value> ..."
 	echo "       ${SCRIPTNAME} [ backup(b) | delete(d) | restore(r) ] <data dir> <snapshot name>"
 	echo "       ${SCRIPTNAME} [ status(t) ]"
 	echo ""
 	echo " [Parameter]"
 	echo "   start(s)           : Start main processes"
 	echo "   stop(a)            : Stop database and unregister(abort)"
+	echo "   serviceout(o)      : Service out this node"
+	echo "   reload(l)          : Reload chmpx with new parameters"
 	echo "   backup(b)          : Run backup mode"
 	echo "   delete(d)          : Run delete backup mode"
 	echo "   restore(r)         : Run restore mode"
@@ -1307,6 +1422,9 @@ Usage()
 	echo ""
 	echo "   <data dir>         : K2HDKC Data Top directory path for backup/restore/delete mode"
 	echo "   <snapshot name>	: Snapshot name(sub-directory name) for backup/restore/delete mode"
+	echo "   <name>=<value>     : Changed parameter for reload mode, the name is one of"
+	echo "                        cluster-name, chmpx-server-port, chmpx-server-ctlport"
+	echo "                        and chmpx-slave-ctlport"
 	echo ""
 	echo " [Options]"
 	echo "   --help(-h)         : Print usage."
@@ -1322,6 +1440,7 @@ Usage()
 RUN_MODE=""
 OPT_DATA_TOP_DIR=""
 OPT_SNAPSHOT_NAME=""
+OPT_RELOAD_PARAMS=""
 
 while [ $# -ne 0 ]; do
 	if [ -z "$1" ]; then
@@ -1349,6 +1468,15 @@ while [ $# -ne 0 ]; do
 	elif echo "$1" | grep -q -i -e "^t$" -e "^status$"; then
 		RUN_MODE="status"
 
+	elif echo "$1" | grep -q -i -e "^o$" -e "^serviceout$"; then
+		RUN_MODE="serviceout"
+
+	elif echo "$1" | grep -q -i -e "^l$" -e "^reload$"; then
+		RUN_MODE="reload"
+
+	elif [ "${RUN_MODE}" = "reload" ]; then
+		OPT_RELOAD_PARAMS="${OPT_RELOAD_PARAMS} $1"
+
 	else
 		if [ -z "${OPT_DATA_TOP_DIR}" ]; then
 			OPT_DATA_TOP_DIR="$1"
@@ -1370,7 +1498,12 @@ if [ -z "${RUN_MODE}" ]; then
 	RUN_MODE="start"
 fi
 
-if [ "${RUN_MODE}" = "start" ] || [ "${RUN_MODE}" = "stop" ] || [ "${RUN_MODE}" = "status" ]; then
+if [ "${RUN_MODE}" = "reload" ]; then
+	if [ -z "${OPT_RELOAD_PARAMS}" ]; then
+		PRNERR "No parameter is specified in reload mode."
+		exit 1
+	fi
+elif [ "${RUN_MODE}" = "start" ] || [ "${RUN_MODE}" = "stop" ] || [ "${RUN_MODE}" = "serviceout" ] || [ "${RUN_MODE}" = "status" ]; then
 	if [ -n "${OPT_DATA_TOP_DIR}" ] || [ -n "${OPT_SNAPSHOT_NAME}" ]; then
 		PRNERR "The data top directory and snapshot name parameters cannot be specified in start mode."
 		exit 1
@@ -1442,6 +1575,11 @@ if [ "${RUN_MODE}" = "start" ]; then
 		exit 1
 	fi
 
+	#
+	# This node joins the ring when it starts
+	#
+	rm -f "${SERVICEOUT_MARKER_FILE}"
+
 	#
 	# Wait until other nodes have also registered
 	#
@@ -1617,6 +1755,24 @@ elif [ "${RUN_MODE}" = "restore" ]; then
 		IS_ERROR=1
 	fi
 
+elif [ "${RUN_MODE}" = "serviceout" ]; then
+	#----------------------------------------------------------
+	# Service out this node
+	#----------------------------------------------------------
+	if ! ServiceOutNode; then
+		PRNERR "Failed to service out this node."
+		IS_ERROR=1
+	fi
+
+elif [ "${RUN_MODE}" = "reload" ]; then
+	#----------------------------------------------------------
+	# Reload chmpx with new parameters
+	#----------------------------------------------------------
+	if ! ReloadNode; then
+		PRNERR "Failed to reload this node."
+		IS_ERROR=1
+	fi
+
 elif [ "${RUN_MODE}" = "status" ]; then
 	#----------------------------------------------------------
 	# Get Conatiner Status
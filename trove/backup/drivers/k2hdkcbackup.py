@@ -18,76 +18,746 @@
 # REVISION:
 #
 from backup.drivers import base
+from oslo_config import cfg
 from oslo_log import log as logging
+import glob
+import hashlib
+import json
+import os
+import queue
+import shutil
 import subprocess
 import shlex
+import tempfile
+import threading
+import time
 
+CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 BACKUP_COMMAND = "/usr/libexec/k2hdkctrove.sh"
 SNAPSHOT_NAME = "trovebackup"
+PROGRESS_INTERVAL = 10
+
+#
+# Compression codecs for the backup stream
+#
+# [NOTE]
+# Each codec has the compression command, the decompression command
+# and the suffix of the manifest. '{threads}' in the commands is replaced
+# by the thread count.
+# The codec name is saved in the metadata of the backup, and the restore
+# selects the decompression command from it.
+# Backups without the metadata were created by 'tar -z' and 'gzip', so
+# they are restored by the legacy command.
+#
+METADATA_CODEC_KEY = 'k2hdkc_codec'
+DEFAULT_CODEC = 'gzip'
+BACKUP_CODECS = {
+    'gzip': ('gzip -c', 'gzip -d -c', '.gz'),
+    'pigz': ('pigz -c -p {threads}', 'pigz -d -c', '.gz'),
+    'zstd': ('zstd -c -q -T{threads}', 'zstd -d -c -q', '.zst'),
+    'none': (None, None, ''),
+}
+LEGACY_RESTORE_COMMAND = '/bin/tar xzpPf - -C /'
+
+#
+# Stream mode
+#
+# [NOTE]
+# In the stream mode, the k2hash archive file is a named pipe. The archive
+# command writes the archive into it and the backup reads it, so the
+# archive is never written to the data volume. The backup object is the
+# compressed archive itself(not a tar file), and it is recorded by the
+# format in the metadata.
+# The restore loads the archive through the named pipe in the same way.
+# If the archive command fails before opening the pipe, the other side is
+# unblocked by opening and closing the pipe.
+#
+METADATA_FORMAT_KEY = 'k2hdkc_format'
+STREAM_FORMAT = 'k2har'
+STREAM_RESTORE_COMMAND = '/bin/dd of={} bs=1M status=none'
+
+#
+# Incremental backup
+#
+# [NOTE]
+# The k2hash archive is split into fixed size chunks and the sha256 of
+# each chunk is saved as the index of the backup on the data volume.
+# An incremental backup compares the index of the new archive with the
+# index of the parent backup, and stores only the changed chunks and the
+# new index. The restore applies the chunks of each backup in the chain
+# to the archive of the full backup.
+# If the index of the parent does not exist on this volume(for example,
+# the instance was restored from another one), all chunks are stored.
+# The index files are grouped by the chain, the id of its full backup, as
+# "index/<chain>/<backup id>.json". Only the chain which was written last
+# is kept, so the index files do not grow with every backup.
+#
+INDEX_CHUNK_SIZE = 4 * 1024 * 1024
+INDEX_DIR_NAME = "index"
+INCREMENTAL_NAME = "trovebackup_inc"
+INCREMENTAL_INDEX_FILE = "index.json"
+INCREMENTAL_CHUNKS_DIR = "chunks"
+
+PIPELINE_CHUNK_SIZE = 2 ** 16
+
+
+class RestoreStage(object):
+    """Counter of the bytes passed through one restore stage."""
+    def __init__(self, name, command=None):
+        self.name = name
+        self.command = command
+        self.process = None
+        self.stderr = None
+        self.bytes = 0
+        self.error = None
+
+    def throughput(self, elapsed):
+        return self.bytes / max(elapsed, 0.001) / 1024 / 1024
+
+
+class RestorePipeline(object):
+    """Staged restore pipeline
+
+    [NOTE]
+    The restore runs the download, decryption(only for the encrypted
+    backup), decompression and archive load stages concurrently. The
+    download runs in a thread and each other stage runs in its own
+    process. The stages are connected by bounded queues, so a fast stage
+    does not wait for a slow stage until the queue between them is full,
+    and the memory is limited by buffer_size per queue.
+    The progress and the throughput of each stage are logged every
+    PROGRESS_INTERVAL seconds. The stage with the full input queue and
+    the lowest throughput is the bottleneck.
+    """
+    def __init__(self, stream, stages, buffer_size):
+        self.stream = stream
+        self.download = RestoreStage('download')
+        self.stages = [RestoreStage(name, command)
+                       for name, command in stages]
+        maxsize = max(buffer_size // PIPELINE_CHUNK_SIZE, 1)
+        self.queues = [queue.Queue(maxsize) for _ in self.stages]
+        self.threads = []
+        self.start_time = None
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _download(self, output):
+        try:
+            for chunk in self.stream:
+                output.put(chunk)
+                self.download.bytes += len(chunk)
+        except Exception as exc:
+            self.download.error = exc
+        finally:
+            output.put(None)
+
+    def _feed(self, stage, input_queue, count=False):
+        """Writes the chunks in the queue to the stage process.
+
+        The last stage has no output, so its input bytes are counted.
+        """
+        while True:
+            chunk = input_queue.get()
+            if chunk is None:
+                break
+            if stage.error:
+                # Drain the queue so that the previous stage can finish.
+                continue
+            try:
+                stage.process.stdin.write(chunk)
+            except (BrokenPipeError, ValueError) as exc:
+                stage.error = exc
+                continue
+            if count:
+                stage.bytes += len(chunk)
+        try:
+            stage.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def _collect(self, stage, output):
+        """Reads the output of the stage process into the next queue."""
+        try:
+            while True:
+                chunk = stage.process.stdout.read(PIPELINE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.put(chunk)
+                stage.bytes += len(chunk)
+        finally:
+            output.put(None)
+
+    def _discard(self, stage):
+        """Reads and discards the output of the last stage."""
+        while stage.process.stdout.read(PIPELINE_CHUNK_SIZE):
+            pass
+
+    def progress(self):
+        elapsed = time.monotonic() - self.start_time
+        stages = ', '.join(
+            '{} {:.1f}MB {:.1f}MB/s'.format(
+                stage.name, stage.bytes / 1024 / 1024,
+                stage.throughput(elapsed))
+            for stage in [self.download] + self.stages)
+        buffers = '/'.join('{}%'.format(q.qsize() * 100 // q.maxsize)
+                           for q in self.queues)
+        return '{}, buffers {}'.format(stages, buffers)
+
+    def run(self):
+        """Runs the pipeline and returns the downloaded bytes."""
+        self.start_time = time.monotonic()
+        for stage in self.stages:
+            stage.stderr = tempfile.TemporaryFile()
+            stage.process = subprocess.Popen(stage.command.split(),
+                                             shell=False,
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             stderr=stage.stderr)
+        self._start_thread(self._download, self.queues[0])
+        for index, stage in enumerate(self.stages):
+            if index + 1 < len(self.stages):
+                self._start_thread(self._feed, stage, self.queues[index])
+                self._start_thread(self._collect, stage,
+                                   self.queues[index + 1])
+            else:
+                self._start_thread(self._feed, stage, self.queues[index],
+                                   True)
+                self._start_thread(self._discard, stage)
+
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(PROGRESS_INTERVAL)
+                if thread.is_alive():
+                    LOG.info("Restore progress: %s", self.progress())
+        for stage in self.stages:
+            stage.process.wait()
+        elapsed = time.monotonic() - self.start_time
+        LOG.info("Restore pipeline finished in %.1fs: %s", elapsed,
+                 self.progress())
+        self._check()
+        return self.download.bytes
+
+    def _check(self):
+        if self.download.error:
+            raise Exception("Failed to download the backup: %s" %
+                            self.download.error)
+        for stage in self.stages:
+            stage.stderr.seek(0)
+            stderr = stage.stderr.read().decode(errors='replace')
+            stage.stderr.close()
+            if stderr:
+                LOG.info("%s stage(%s) stderr: %s", stage.name,
+                         stage.command, stderr)
+            if stage.process.returncode != 0 or stage.error:
+                raise Exception("Failed to restore the backup in the %s "
+                                "stage(%s), returncode: %s, error: %s" % (
+                                    stage.name, stage.command,
+                                    stage.process.returncode,
+                                    stderr or stage.error))
+
 
 class K2hdkcBackup(base.BaseRunner):
     """Backup and Restore Implementation"""
     def __init__(self, *args, **kwargs):
         LOG.info("args:{} kwargs:{}".format(args, kwargs))
         self.datadir = kwargs.pop('db-datadir', '/var/lib/antpickax/k2hdkc')
+        self.stream = CONF.k2hdkc_stream
+        self.archive_process = None
         super(K2hdkcBackup, self).__init__(*args, **kwargs)
-        self.restore_command = '/bin/tar xzpPf - -C /'
+        self.restore_command = '/bin/tar xpPf - -C /'
         self.backup_log = '/var/log/antpickax/k2hdkcbackup.log'
-        self._gzip = True
-        self.timeout = 60
+        self.archive_log = '/var/log/antpickax/k2hdkcarchive.log'
+        self.codec = CONF.k2hdkc_codec or DEFAULT_CODEC
+        self.codec_threads = CONF.k2hdkc_codec_threads
+        self._gzip = False
+        self.timeout = CONF.k2hdkc_command_timeout
+        self.min_throughput = CONF.k2hdkc_min_throughput
+        self.pipeline_buffer = CONF.k2hdkc_pipeline_buffer * 1024 * 1024
 
     @property
     def cmd(self):
-        cmd = (f"/bin/tar -zcpPf - {self.datadir}/snapshots/trovebackup")
+        if self.stream:
+            return f"/bin/cat {self.archive_file}" + self.encrypt_cmd
+        cmd = (f"/bin/tar -cpPf - {self.datadir}/snapshots/trovebackup")
         return cmd + self.encrypt_cmd
 
-    def _run_command(self, command, timeout):
+    @property
+    def zip_manifest(self):
+        return BACKUP_CODECS[self.codec][2]
+
+    def _codec_command(self, codec, index):
+        """Returns the (de)compression command of the codec, or None."""
+        command = BACKUP_CODECS[codec][index]
+        if not command:
+            return None
+        threads = self.codec_threads
+        if threads <= 0 and codec == 'pigz':
+            threads = os.cpu_count() or 1
+        return command.format(threads=max(threads, 0))
+
+    def _run(self):
+        """Runs the tar command and pipes it to the codec command."""
+        compress_command = self._codec_command(self.codec, 0)
+        LOG.info("Running backup cmd: %s | %s", self.command,
+                 compress_command)
+        with open(self.backup_log, "w+") as fp:
+            if not compress_command:
+                self.process = subprocess.Popen(self.command.split(),
+                                                shell=False,
+                                                stdout=subprocess.PIPE,
+                                                stderr=fp,
+                                                preexec_fn=os.setsid)
+            else:
+                tar_process = subprocess.Popen(self.command.split(),
+                                               shell=False,
+                                               stdout=subprocess.PIPE,
+                                               stderr=fp)
+                self.process = subprocess.Popen(compress_command.split(),
+                                                shell=False,
+                                                stdin=tar_process.stdout,
+                                                stdout=subprocess.PIPE,
+                                                stderr=fp)
+                tar_process.stdout.close()
+            self.pid = self.process.pid
+
+    def get_metadata(self):
+        metadata = {METADATA_CODEC_KEY: self.codec}
+        if self.stream:
+            metadata[METADATA_FORMAT_KEY] = STREAM_FORMAT
+        return metadata
+
+    def _load_codec(self, location, checksum):
+        """Returns the codec name saved in the metadata of the backup."""
+        if not self.storage or not location:
+            return None
+        metadata = self.storage.load_metadata(location, checksum)
+        codec = metadata.get(METADATA_CODEC_KEY)
+        if codec and codec not in BACKUP_CODECS:
+            raise Exception("Unknown codec %s in the backup metadata." % codec)
+        return codec
+
+    def run_restore(self):
+        metadata = self.storage.load_metadata(self.location, self.checksum)
+        if metadata.get(METADATA_FORMAT_KEY) == STREAM_FORMAT:
+            return self._restore_stream(self.location, self.checksum)
+        self.stream = False
+        return self._restore_from(self.location, self.checksum,
+                                  self.restore_command)
+
+    def _restore_stream(self, location, checksum):
+        """Loads the archive from the storage through the named pipe."""
+        self.stream = True
+        self._start_archive_stream('restore', os.O_RDONLY)
+        try:
+            content_length = self._restore_from(
+                location, checksum,
+                STREAM_RESTORE_COMMAND.format(self.archive_file))
+        finally:
+            returncode = self._wait_archive_stream()
+        if returncode != 0:
+            raise Exception("Failed to load the k2hash archive, see %s" %
+                            self.archive_log)
+        return content_length
+
+    def _restore_from(self, location, checksum, restore_command):
+        """Unpacks one backup object with the codec in its metadata."""
+        codec = self._load_codec(location, checksum)
+        if not codec:
+            LOG.info("No codec in the backup metadata, restore by %s",
+                     LEGACY_RESTORE_COMMAND)
+            self._gzip = True
+            return self.unpack(location, checksum, LEGACY_RESTORE_COMMAND)
+
+        self._gzip = False
+        stages = []
+        if location.endswith('.enc') and self.encrypt_key:
+            stages.append(('decrypt', self.decrypt_cmd.rstrip('| ')))
+        decompress_command = self._codec_command(codec, 1)
+        if decompress_command:
+            stages.append(('decompress', decompress_command))
+        stages.append(('load', restore_command))
+        LOG.info("Running restore from stream, command: %s",
+                 ' | '.join(command for _, command in stages))
+
+        pipeline = RestorePipeline(self.storage.load(location, checksum),
+                                   stages, self.pipeline_buffer)
+        content_length = pipeline.run()
+        self.process = pipeline.stages[-1].process
+        return content_length
+
+    def _data_size(self):
+        """Returns the total size of the k2hash files in datadir."""
+        total = 0
+        for root, dirs, files in os.walk(self.datadir):
+            if root == self.datadir and 'snapshots' in dirs:
+                dirs.remove('snapshots')
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def _file_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _get_timeout(self, size):
+        """Returns the timeout for processing size bytes.
+
+        The timeout is k2hdkc_command_timeout or the time to process the
+        size at k2hdkc_min_throughput(MB/s), whichever is longer.
+        k2hdkc_min_throughput of 0 disables the timeout.
+        """
+        if self.min_throughput <= 0:
+            return None
+        return max(self.timeout,
+                   int(size / (self.min_throughput * 1024 * 1024)))
+
+    def _run_command(self, command, timeout, progress=None):
+        """Runs the command and returns True if it exits with 0.
+
+        progress is a function which returns the processed bytes, and it
+        is logged every PROGRESS_INTERVAL seconds.
+        """
         if not command:
             return False
         command_args = shlex.split(command)
         LOG.info("command_args:{} timeout:{}".format(command_args, timeout))
+        start = time.monotonic()
         # Create new Popen instance.
         proc = subprocess.Popen(
                 command_args,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE)
         with proc:
-            # communicate() returns a tuple (stdout_data, stderr_data)
-            try:
-                stdout, stderr = proc.communicate(input=None, timeout=timeout)
-                LOG.info("stdout:{} stderr:{}".format(stdout.decode(), stderr.decode()))
-                LOG.info("proc.pid:{} proc.returncode:{}".format(proc.pid, proc.returncode))
-                print("True")
-            except TimeoutExpired:
-                proc.kill()
-                _, stderr = proc.communicate()
-                LOG.error("TimeoutExpired stderr:{}".format(stderr.decode()))
+            while True:
+                try:
+                    stdout, stderr = proc.communicate(
+                        timeout=PROGRESS_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    elapsed = time.monotonic() - start
+                    if progress:
+                        processed = progress()
+                        LOG.info("{} in progress, {} bytes in {:.0f}s "
+                                 "({:.1f} MB/s)".format(
+                                     ' '.join(command_args[:2]),
+                                     processed, elapsed,
+                                     processed / elapsed / 1024 / 1024))
+                    if timeout is not None and elapsed > timeout:
+                        proc.kill()
+                        _, stderr = proc.communicate()
+                        LOG.error("TimeoutExpired({}s) stderr:{}".format(
+                            timeout, stderr.decode()))
+                        return False
+        LOG.info("stdout:{} stderr:{}".format(stdout.decode(), stderr.decode()))
+        LOG.info("proc.pid:{} proc.returncode:{} elapsed:{:.1f}s".format(
+            proc.pid, proc.returncode, time.monotonic() - start))
+        return proc.returncode == 0
+
+    @property
+    def archive_file(self):
+        return os.path.join(self.datadir, 'snapshots', SNAPSHOT_NAME,
+                            SNAPSHOT_NAME + '.k2har')
+
+    @property
+    def index_dir(self):
+        return os.path.join(self.datadir, 'snapshots', INDEX_DIR_NAME)
+
+    def _load_index(self, backup_id):
+        """Returns the chunk index of the backup and its chain id.
+
+        (None, None) is returned if the index is not on this volume.
+        """
+        if not backup_id:
+            return None, None
+        paths = glob.glob(os.path.join(self.index_dir, '*',
+                                       '{}.json'.format(backup_id)))
+        if not paths:
+            LOG.warning("No index of %s on this volume.", backup_id)
+            return None, None
+        try:
+            with open(paths[0], 'r') as fp:
+                return json.load(fp), os.path.basename(
+                    os.path.dirname(paths[0]))
+        except (IOError, ValueError) as exc:
+            LOG.warning("Could not load the index of %s: %s", backup_id, exc)
+            return None, None
+
+    def _save_index(self, index, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(index, fp)
+        os.replace(path + '.tmp', path)
+
+    def _save_chain_index(self, index, chain_id):
+        """Saves the index of this backup and removes the other chains."""
+        if not self.base_filename:
+            return
+        self._save_index(index, os.path.join(
+            self.index_dir, chain_id, '{}.json'.format(self.base_filename)))
+        for name in os.listdir(self.index_dir):
+            if name == chain_id:
+                continue
+            path = os.path.join(self.index_dir, name)
+            LOG.info("Removing the index of the old backup chain %s", name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError as exc:
+                    LOG.warning("Could not remove %s: %s", path, exc)
+
+    def _scan_archive(self, chunk_callback=None):
+        """Returns the chunk index of the k2hash archive.
+
+        chunk_callback(number, chunk, digest) is called for each chunk.
+        """
+        hashes = []
+        size = 0
+        with open(self.archive_file, 'rb') as fp:
+            while True:
+                chunk = fp.read(INDEX_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest = hashlib.sha256(chunk).hexdigest()
+                if chunk_callback:
+                    chunk_callback(len(hashes), chunk, digest)
+                hashes.append(digest)
+                size += len(chunk)
+        return {'chunk_size': INDEX_CHUNK_SIZE, 'size': size,
+                'hashes': hashes}
+
+    def _create_archive(self):
+        command = '{} backup {} {}'.format(BACKUP_COMMAND, self.datadir, SNAPSHOT_NAME)
+        timeout = self._get_timeout(self._data_size())
+        if not self._run_command(command, timeout,
+                                 lambda: self._file_size(self.archive_file)):
+            raise Exception("Failed to create the k2hash archive.")
+
+    def _remove_archive(self):
+        try:
+            os.remove(self.archive_file)
+        except FileNotFoundError:
+            pass
+
+    def _start_archive_stream(self, action, unblock_flags):
+        """Starts the archive command with the named pipe as the archive."""
+        self._remove_archive()
+        os.makedirs(os.path.dirname(self.archive_file), exist_ok=True)
+        os.mkfifo(self.archive_file, 0o600)
+        command = '{} {} {} {}'.format(BACKUP_COMMAND, action, self.datadir, SNAPSHOT_NAME)
+        LOG.info("Starting the archive stream, command: %s", command)
+        with open(self.archive_log, 'w+') as fp:
+            self.archive_process = subprocess.Popen(shlex.split(command),
+                                                    stdout=fp,
+                                                    stderr=subprocess.STDOUT)
+        threading.Thread(target=self._watch_archive_stream,
+                         args=(self.archive_process, unblock_flags),
+                         daemon=True).start()
+
+    def _watch_archive_stream(self, process, unblock_flags):
+        """Unblocks the named pipe if the archive command failed."""
+        if process.wait() == 0:
+            return
+        LOG.error("The archive command exited with %d", process.returncode)
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if self._unblock_fifo(unblock_flags):
+                return
+            time.sleep(0.1)
+
+    def _unblock_fifo(self, flags):
+        """Opens and closes the named pipe if the other side is opened.
+
+        The other side gets EOF(reader) or EPIPE(writer).
+        """
+        try:
+            fd = os.open(self.archive_file, flags | os.O_NONBLOCK)
+        except FileNotFoundError:
+            return True
+        except OSError:
             return False
-        LOG.info("True")   # code doesn't come here. why???
-        return True
+        try:
+            if flags == os.O_WRONLY:
+                return True
+            # The read returns b'' only when there is no writer.
+            return os.read(fd, 1) != b''
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def _wait_archive_stream(self):
+        try:
+            returncode = self.archive_process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.archive_process.kill()
+            returncode = self.archive_process.wait()
+        with open(self.archive_log, 'r') as fp:
+            LOG.info("archive command returncode:%d output:%s", returncode,
+                     fp.read())
+        self._remove_archive()
+        return returncode
 
     """pre_backup"""
     def pre_backup(self):
         LOG.info("pre_backup")
-        command = '{} backup {} {}'.format(BACKUP_COMMAND, self.datadir, SNAPSHOT_NAME)
-        self._run_command(command, self.timeout)
+        if self.stream:
+            self._start_archive_stream('backup', os.O_WRONLY)
+            return
+        self._create_archive()
+        if os.path.isfile(self.archive_file):
+            self._save_chain_index(self._scan_archive(), self.base_filename)
 
     """post_backup"""
     def post_backup(self):
         LOG.info("post_backup")
+        if self.stream:
+            return
         command = '{} delete {} {}'.format(BACKUP_COMMAND, self.datadir, SNAPSHOT_NAME)
-        self._run_command(command, self.timeout)
+        if not self._run_command(command, self.timeout):
+            LOG.warning("Failed to delete the k2hash archive.")
 
     """post_restore"""
     def post_restore(self):
         LOG.info("post_restore")
+        if self.stream:
+            return
         command = '{} restore {} {}'.format(BACKUP_COMMAND, self.datadir, SNAPSHOT_NAME)
-        self._run_command(command, self.timeout)
+        timeout = self._get_timeout(self._file_size(self.archive_file))
+        if not self._run_command(command, timeout, self._data_size):
+            raise Exception("Failed to restore from the k2hash archive.")
 
     def check_process(self):
+        if self.stream and self.archive_process:
+            return self._wait_archive_stream() == 0
         return True
 
+
+class K2hdkcBackupIncremental(K2hdkcBackup):
+    """Incremental Backup and Restore Implementation"""
+    def __init__(self, *args, **kwargs):
+        self.parent_location = kwargs.pop('parent_location', '')
+        self.parent_checksum = kwargs.pop('parent_checksum', '')
+        super(K2hdkcBackupIncremental, self).__init__(*args, **kwargs)
+        # The chunk index needs the archive file, so the incremental
+        # backup does not use the stream mode.
+        self.stream = False
+
+    @property
+    def incremental_dir(self):
+        return os.path.join(self.datadir, 'snapshots', INCREMENTAL_NAME)
+
+    @property
+    def cmd(self):
+        cmd = (f"/bin/tar -cpPf - {self.incremental_dir}")
+        return cmd + self.encrypt_cmd
+
+    def get_metadata(self):
+        metadata = super(K2hdkcBackupIncremental, self).get_metadata()
+        metadata.update({
+            'parent_location': self.parent_location,
+            'parent_checksum': self.parent_checksum,
+        })
+        return metadata
+
+    """pre_backup"""
+    def pre_backup(self):
+        LOG.info("pre_backup(incremental), parent: %s", self.parent_location)
+        self._create_archive()
+
+        parent_id = os.path.basename(self.parent_location).split('.')[0]
+        parent_index, chain_id = self._load_index(parent_id)
+        parent_hashes = []
+        if parent_index and parent_index.get('chunk_size') == INDEX_CHUNK_SIZE:
+            parent_hashes = parent_index.get('hashes', [])
+        else:
+            LOG.warning("No usable index of the parent %s, all chunks are "
+                        "stored.", parent_id)
+
+        chunks_dir = os.path.join(self.incremental_dir, INCREMENTAL_CHUNKS_DIR)
+        shutil.rmtree(self.incremental_dir, ignore_errors=True)
+        os.makedirs(chunks_dir)
+        changed = []
+
+        def _store_changed_chunk(number, chunk, digest):
+            if (number < len(parent_hashes) and
+                    parent_hashes[number] == digest):
+                return
+            with open(os.path.join(chunks_dir, str(number)), 'wb') as fp:
+                fp.write(chunk)
+            changed.append(number)
+
+        index = self._scan_archive(_store_changed_chunk)
+        self._save_index(index, os.path.join(self.incremental_dir,
+                                             INCREMENTAL_INDEX_FILE))
+        self._save_chain_index(index, chain_id or self.base_filename)
+        LOG.info("%d of %d chunks are changed from the parent.",
+                 len(changed), len(index['hashes']))
+
+    """post_backup"""
+    def post_backup(self):
+        super(K2hdkcBackupIncremental, self).post_backup()
+        shutil.rmtree(self.incremental_dir, ignore_errors=True)
+
+    def run_restore(self):
+        return self._incremental_restore(self.location, self.checksum)
+
+    def _incremental_restore(self, location, checksum):
+        """Recursively restores the parents and applies the chunks."""
+        metadata = self.storage.load_metadata(location, checksum)
+        if 'parent_location' not in metadata:
+            LOG.info("Restoring back to full backup.")
+            if metadata.get(METADATA_FORMAT_KEY) != STREAM_FORMAT:
+                return self._restore_from(location, checksum,
+                                          self.restore_command)
+            # The full backup was created in the stream mode, so restore
+            # it to the archive file to apply the chunks.
+            self._remove_archive()
+            os.makedirs(os.path.dirname(self.archive_file), exist_ok=True)
+            return self._restore_from(
+                location, checksum,
+                STREAM_RESTORE_COMMAND.format(self.archive_file))
+
+        LOG.info("Restoring parent: %(parent_location)s, "
+                 "checksum: %(parent_checksum)s.", metadata)
+        content_length = self._incremental_restore(
+            metadata['parent_location'], metadata['parent_checksum'])
+
+        shutil.rmtree(self.incremental_dir, ignore_errors=True)
+        content_length += self._restore_from(location, checksum,
+                                             self.restore_command)
+        self._apply_chunks()
+        shutil.rmtree(self.incremental_dir, ignore_errors=True)
+        return content_length
+
+    def _apply_chunks(self):
+        """Writes the restored chunks into the k2hash archive."""
+        with open(os.path.join(self.incremental_dir,
+                               INCREMENTAL_INDEX_FILE), 'r') as fp:
+            index = json.load(fp)
+        chunks_dir = os.path.join(self.incremental_dir, INCREMENTAL_CHUNKS_DIR)
+        chunk_size = index['chunk_size']
+        names = os.listdir(chunks_dir)
+
+        with open(self.archive_file, 'r+b') as archive:
+            for name in names:
+                with open(os.path.join(chunks_dir, name), 'rb') as fp:
+                    archive.seek(int(name) * chunk_size)
+                    archive.write(fp.read())
+            archive.truncate(index['size'])
+        LOG.info("Applied %d chunks to %s, size: %d", len(names),
+                 self.archive_file, index['size'])
+
 #
 # Local variables:
 # tab-width: 4
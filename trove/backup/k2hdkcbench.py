@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+#
+# K2HDKC DBaaS based on Trove
+#
+# Copyright 2020 Yahoo Japan Corporation
+#
+# K2HDKC DBaaS is a Database as a Service compatible with Trove which
+# is DBaaS for OpenStack.
+# Using K2HR3 as backend and incorporating it into Trove to provide
+# DBaaS functionality. K2HDKC, K2HR3, CHMPX and K2HASH are components
+# provided as AntPickax.
+#
+# For the full copyright and license information, please view
+# the license file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Sun, Oct 18 2026
+# REVISION:
+#
+"""Throughput benchmark of the k2hdkc backup driver.
+
+This generates synthetic k2hash archives, and runs the backup and restore
+pipelines of K2hdkcBackup against a local filesystem storage. The archive
+commands(k2hdkctrove.sh) are not run, so this works in the backup image
+without k2hdkc.
+
+Example(in the backup container):
+    python3 k2hdkcbench.py --sizes 64,512 --codecs gzip,zstd \\
+        --chunk-sizes 16,128 --output result.json
+    python3 k2hdkcbench.py --sizes 64,512 --baseline result.json
+
+With --baseline, the throughput is compared with the previous result and
+the exit code is 1 if any case is slower than --tolerance.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+topdir = os.path.normpath(
+    os.path.join(os.path.abspath(sys.argv[0]), os.pardir, os.pardir))
+sys.path.insert(0, topdir)
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+MB = 1024 * 1024
+DEFAULT_WORKDIR = '/tmp/k2hdkcbench'
+STORAGE_DIR_NAME = 'storage'
+METADATA_SUFFIX = '.metadata'
+
+
+class LocalStorage(object):
+    """Filesystem stand-in of the swift storage.
+
+    The stream is saved in segments of chunk_size like the swift storage
+    drivers, and the md5 of each segment is checked on load.
+    """
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.stored_bytes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def save(self, stream, metadata=None, container=None):
+        filename = stream.manifest
+        segments = []
+        while True:
+            data = stream.read(self.chunk_size)
+            if not data:
+                break
+            name = '%s_%08d' % (filename, len(segments))
+            with open(os.path.join(self.path, name), 'wb') as fp:
+                fp.write(data)
+            segments.append({'name': name,
+                             'hash': hashlib.md5(data).hexdigest()})
+            self.stored_bytes += len(data)
+
+        metadata = dict(metadata or {})
+        metadata.update(stream.get_metadata())
+        location = os.path.join(self.path, filename)
+        with open(location, 'w') as fp:
+            json.dump(segments, fp)
+        with open(location + METADATA_SUFFIX, 'w') as fp:
+            json.dump(metadata, fp)
+        checksum = hashlib.md5(
+            ''.join(s['hash'] for s in segments).encode()).hexdigest()
+        return checksum, location
+
+    def load(self, location, checksum):
+        with open(location, 'r') as fp:
+            segments = json.load(fp)
+        for segment in segments:
+            with open(os.path.join(self.path, segment['name']), 'rb') as fp:
+                data = fp.read()
+            if hashlib.md5(data).hexdigest() != segment['hash']:
+                raise Exception('Checksum validation failure of %s' %
+                                segment['name'])
+            for offset in range(0, len(data), 2 ** 16):
+                yield data[offset:offset + 2 ** 16]
+
+    def load_metadata(self, location, checksum):
+        if not location:
+            return {}
+        with open(location + METADATA_SUFFIX, 'r') as fp:
+            return json.load(fp)
+
+    def is_incremental_backup(self, location):
+        return 'parent_location' in self.load_metadata(location, None)
+
+
+def generate_archive(path, size, key_distribution, key_count, value_size,
+                     seed=0):
+    """Writes a synthetic k2hash archive of size bytes.
+
+    Each record is a length prefixed key and value like the k2hash archive.
+    The keys are drawn from key_count keys uniformly or by zipf, and the
+    values are a mix of text and random bytes, so the compression ratio is
+    close to the real data.
+    """
+    rand = random.Random(seed)
+    words = [('word%d' % i).encode() for i in range(1024)]
+    written = 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        while written < size:
+            if key_distribution == 'zipf':
+                index = min(int(rand.paretovariate(1.2)), key_count) - 1
+            else:
+                index = rand.randrange(key_count)
+            key = b'/k2hdkc/bench/key/%08d' % index
+            length = max(int(rand.gauss(value_size, value_size / 4)), 1)
+            text = b' '.join(rand.choice(words)
+                             for _ in range(length // 16 + 1))
+            value = (text[:length // 2] +
+                     rand.getrandbits(8 * (length - length // 2)).to_bytes(
+                         length - length // 2, 'little'))
+            record = (struct.pack('<QQ', len(key), len(value)) + key + value)
+            fp.write(record)
+            written += len(record)
+    return written
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(MB), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reap_children():
+    """Waits for the backup processes, so that their CPU time is counted.
+
+    The backup runner does not wait for the tar and codec processes.
+    """
+    while True:
+        try:
+            os.waitpid(-1, 0)
+        except ChildProcessError:
+            return
+
+
+def _rusage():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (usage_self.ru_utime + usage_self.ru_stime +
+           usage_children.ru_utime + usage_children.ru_stime)
+    # ru_maxrss is in kilobytes on Linux
+    rss = max(usage_self.ru_maxrss, usage_children.ru_maxrss) * 1024
+    return cpu, rss
+
+
+def _run_case(workdir, archive, codec, chunk_size, results):
+    """Runs one backup and restore, this runs in a forked process.
+
+    The process is forked for each case, so the peak RSS is not shared
+    with the other cases.
+    """
+    from backup.drivers import k2hdkcbackup
+
+    class BenchBackup(k2hdkcbackup.K2hdkcBackup):
+        """K2hdkcBackup without the archive commands"""
+        def pre_backup(self):
+            pass
+
+        def post_backup(self):
+            pass
+
+        def post_restore(self):
+            pass
+
+    CONF.set_override('k2hdkc_codec', codec)
+    CONF.set_override('k2hdkc_stream', False)
+    datadir = os.path.join(workdir, 'data')
+    storage = LocalStorage(os.path.join(workdir, STORAGE_DIR_NAME,
+                                        '%s-%d' % (codec, chunk_size)),
+                           chunk_size)
+    size = os.path.getsize(archive)
+    result = {'codec': codec, 'chunk_size': chunk_size, 'size': size}
+
+    start_cpu, _ = _rusage()
+    start = time.monotonic()
+    runner = BenchBackup(filename='bench', **{'db-datadir': datadir})
+    runner.backup_log = os.path.join(workdir, 'backup.log')
+    with runner as bkup:
+        checksum, location = storage.save(bkup)
+    _reap_children()
+    result['backup_seconds'] = time.monotonic() - start
+    end_cpu, rss = _rusage()
+    result['backup_cpu'] = end_cpu - start_cpu
+    result['backup_rss'] = rss
+    result['stored'] = storage.stored_bytes
+
+    expected = _file_sha256(archive)
+    os.remove(archive)
+    start_cpu = end_cpu
+    start = time.monotonic()
+    runner = BenchBackup(storage=storage, location=location,
+                         checksum=checksum, **{'db-datadir': datadir})
+    runner.restore()
+    result['restore_seconds'] = time.monotonic() - start
+    end_cpu, rss = _rusage()
+    result['restore_cpu'] = end_cpu - start_cpu
+    result['restore_rss'] = rss
+    result['verified'] = (_file_sha256(archive) == expected)
+    shutil.rmtree(storage.path, ignore_errors=True)
+    results.put(result)
+
+
+def run_case(workdir, archive, codec, chunk_size):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=_run_case,
+                              args=(workdir, archive, codec, chunk_size,
+                                    results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception('Benchmark of %s/%d failed, exitcode: %d' %
+                        (codec, chunk_size, process.exitcode))
+    result = results.get()
+    result['backup_mbps'] = result['size'] / MB / result['backup_seconds']
+    result['restore_mbps'] = result['size'] / MB / result['restore_seconds']
+    result['ratio'] = result['size'] / max(result['stored'], 1)
+    return result
+
+
+def print_results(results):
+    print('%-6s %6s %8s %9s %9s %8s %8s %8s %8s %6s %s' % (
+        'codec', 'chunk', 'size(MB)', 'bkup MB/s', 'rstr MB/s', 'bkup cpu',
+        'rstr cpu', 'bkup rss', 'rstr rss', 'ratio', 'verified'))
+    for r in results:
+        print('%-6s %6d %8.0f %9.1f %9.1f %8.2f %8.2f %8.0f %8.0f %6.2f %s' % (
+            r['codec'], r['chunk_size'] // MB, r['size'] / MB,
+            r['backup_mbps'], r['restore_mbps'], r['backup_cpu'],
+            r['restore_cpu'], r['backup_rss'] / MB, r['restore_rss'] / MB,
+            r['ratio'], r['verified']))
+
+
+def compare_baseline(results, baseline_file, tolerance):
+    """Returns the cases slower than the baseline by tolerance."""
+    with open(baseline_file, 'r') as fp:
+        baseline = {(r['codec'], r['chunk_size'], r['size']): r
+                    for r in json.load(fp)}
+    regressions = []
+    for result in results:
+        base = baseline.get((result['codec'], result['chunk_size'],
+                             result['size']))
+        if not base:
+            continue
+        for key in ('backup_mbps', 'restore_mbps'):
+            if result[key] < base[key] * (1 - tolerance):
+                regressions.append('%s/%dMB/%dMB %s: %.1f < %.1f' % (
+                    result['codec'], result['chunk_size'] // MB,
+                    result['size'] // MB, key, result[key], base[key]))
+    return regressions
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Throughput benchmark of the k2hdkc backup driver.')
+    parser.add_argument('--sizes', type=_int_list, default=[64, 256],
+                        help='Archive sizes(MB), comma separated.')
+    parser.add_argument('--codecs', default='gzip,pigz,zstd,none',
+                        help='Codecs, comma separated.')
+    parser.add_argument('--chunk-sizes', type=_int_list, default=[16, 128],
+                        help='Storage segment sizes(MB), comma separated.')
+    parser.add_argument('--key-distribution', default='uniform',
+                        choices=['uniform', 'zipf'])
+    parser.add_argument('--key-count', type=int, default=1000000)
+    parser.add_argument('--value-size', type=int, default=512,
+                        help='Average value size(bytes).')
+    parser.add_argument('--codec-threads', type=int, default=0)
+    parser.add_argument('--pipeline-buffer', type=int, default=64,
+                        help='Restore pipeline buffer(MB).')
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR)
+    parser.add_argument('--output', help='Write the results as JSON.')
+    parser.add_argument('--baseline', help='Previous JSON result to compare.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed throughput drop from the baseline.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    from backup import main as backup_main
+    CONF.register_cli_opts(backup_main.cli_opts)
+    logging.register_options(CONF)
+    CONF([], project='trove-backup')
+    logging.setup(CONF, 'trove-backup')
+    CONF.set_override('k2hdkc_codec_threads', args.codec_threads)
+    CONF.set_override('k2hdkc_pipeline_buffer', args.pipeline_buffer)
+
+    results = []
+    for size in args.sizes:
+        workdir = os.path.join(args.workdir, '%dMB' % size)
+        shutil.rmtree(workdir, ignore_errors=True)
+        archive = os.path.join(workdir, 'data', 'snapshots', 'trovebackup',
+                               'trovebackup.k2har')
+        generate_archive(archive, size * MB, args.key_distribution,
+                         args.key_count, args.value_size)
+        for codec in args.codecs.split(','):
+            for chunk_size in args.chunk_sizes:
+                results.append(run_case(workdir, archive, codec,
+                                        chunk_size * MB))
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if not all(r['verified'] for r in results):
+        print('Restored archive does not match the original.')
+        return 1
+    if args.baseline:
+        regressions = compare_baseline(results, args.baseline,
+                                       args.tolerance)
+        for regression in regressions:
+            print('Regression: %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: expandtab sw=4 ts=4 fdm=marker
+# vim<600: expandtab sw=4 ts=4
+#
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# K2HDKC DBaaS based on Trove
+#
+# Copyright 2020 Yahoo Japan Corporation
+#
+# K2HDKC DBaaS is a Database as a Service compatible with Trove which
+# is DBaaS for OpenStack.
+# Using K2HR3 as backend and incorporating it into Trove to provide
+# DBaaS functionality. K2HDKC, K2HR3, CHMPX and K2HASH are components
+# provided as AntPickax.
+#
+# For the full copyright and license information, please view
+# the license file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Sun, Oct 18 2026
+# REVISION:
+#
+from backup.storage import swift
+from concurrent import futures
+from oslo_config import cfg
+from oslo_log import log as logging
+import hashlib
+import json
+import threading
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+MIN_SEGMENT_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 2 ** 16
+
+
+class K2hdkcSwiftStorage(swift.SwiftStorage):
+    """Swift storage with the parallel segment upload and download
+
+    [NOTE]
+    The stream is split into fixed size segments, and the segments are
+    uploaded concurrently as a static large object. Each segment keeps
+    its md5 in the manifest, so swift validates each segment and the
+    restore validates each downloaded segment.
+    The restore downloads the segments concurrently and yields them in
+    order, so the driver can decompress the backup as a stream.
+    The number of segments in memory is limited by the concurrency.
+    """
+    def __init__(self):
+        super(K2hdkcSwiftStorage, self).__init__()
+        self.segment_size = max(
+            (CONF.k2hdkc_segment_size or 0) * 1024 * 1024, MIN_SEGMENT_SIZE)
+        self.concurrency = max(CONF.k2hdkc_segment_concurrency or 1, 1)
+        self._local = threading.local()
+
+    def _thread_client(self):
+        """Returns the swift client of the current thread.
+
+        swiftclient.Connection is not thread safe, so each worker has
+        its own connection.
+        """
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = swift._get_service_client(
+                CONF.os_auth_url, CONF.os_token, CONF.os_tenant_id,
+                region_name=CONF.os_region_name)
+            self._local.client = client
+        return client
+
+    def _read_segment(self, stream):
+        """Reads one segment from the stream, returns b'' at the end."""
+        buf = bytearray()
+        while len(buf) < self.segment_size:
+            chunk = stream.read(min(READ_CHUNK_SIZE,
+                                    self.segment_size - len(buf)))
+            if not chunk:
+                break
+            buf += chunk
+        return bytes(buf)
+
+    def _upload_segment(self, container, name, data):
+        checksum = hashlib.md5(data).hexdigest()
+        etag = self._thread_client().put_object(container, name, data)
+        if etag != checksum:
+            raise Exception('Failed to upload data segment %s to swift. '
+                            'ETAG: %s Segment MD5: %s.' %
+                            (name, etag, checksum))
+        LOG.debug('Uploaded segment %s, size: %d', name, len(data))
+        return {'path': '%s/%s' % (container, name),
+                'etag': etag,
+                'size_bytes': len(data)}
+
+    def save(self, stream, metadata=None, container='database_backups'):
+        """Persist data from the stream to swift with parallel uploads.
+
+        :returns the new object checkshum and swift full URL.
+        """
+        filename = stream.manifest
+        base_filename = filename.split('.')[0]
+        LOG.info('Saving %(filename)s to %(container)s in swift, segment '
+                 'size: %(size)d, concurrency: %(concurrency)d.',
+                 {'filename': filename, 'container': container,
+                  'size': self.segment_size,
+                  'concurrency': self.concurrency})
+        self.client.put_container(container)
+
+        location = "%s/%s/%s" % (self.client.url, container, filename)
+        LOG.info('Uploading to %s', location)
+
+        segment_results = []
+        data = self._read_segment(stream)
+        if len(data) >= self.segment_size:
+            pending = []
+            with futures.ThreadPoolExecutor(self.concurrency) as executor:
+                while data:
+                    name = '%s_%08d' % (base_filename, len(pending))
+                    pending.append(executor.submit(
+                        self._upload_segment, container, name, data))
+                    data = None
+
+                    # Limit the segments in memory to the concurrency
+                    running = [f for f in pending if not f.done()]
+                    if len(running) >= self.concurrency:
+                        futures.wait(running,
+                                     return_when=futures.FIRST_COMPLETED)
+                    for future in pending:
+                        if future.done() and future.exception():
+                            raise future.exception()
+
+                    data = self._read_segment(stream)
+                segment_results = [future.result() for future in pending]
+            LOG.debug('File uploaded in %s segments.', len(segment_results))
+
+        if metadata is None:
+            metadata = {}
+        metadata.update(stream.get_metadata())
+        headers = {}
+        for key, value in metadata.items():
+            headers[swift._set_attr(key)] = value
+        LOG.info('Metadata headers: %s', headers)
+
+        if segment_results:
+            manifest_data = json.dumps(segment_results)
+            LOG.info('Creating the SLO manifest file with %d segments.',
+                     len(segment_results))
+            self.client.put_object(container, filename, manifest_data,
+                                   headers=headers,
+                                   query_string='multipart-manifest=put')
+            swift_checksum = hashlib.md5()
+            for result in segment_results:
+                swift_checksum.update(result['etag'].encode())
+            final_swift_checksum = swift_checksum.hexdigest()
+        else:
+            # Smaller than one segment, put it as one object.
+            final_swift_checksum = hashlib.md5(data).hexdigest()
+            etag = self.client.put_object(container, filename, data,
+                                          headers=headers)
+            if etag != final_swift_checksum:
+                raise Exception('Failed to upload data to swift. ETAG: %s '
+                                'MD5: %s' % (etag, final_swift_checksum))
+
+        resp = self.client.head_object(container, filename)
+        etag = resp['etag'].strip('"')
+        if etag != final_swift_checksum:
+            msg = ('Failed to upload data to swift. Manifest ETAG: %(tag)s '
+                   'Swift MD5: %(checksum)s' %
+                   {'tag': etag, 'checksum': final_swift_checksum})
+            raise Exception(msg)
+
+        return (final_swift_checksum, location)
+
+    def _download_segment(self, segment):
+        container, name = segment['name'].lstrip('/').split('/', 1)
+        _, data = self._thread_client().get_object(container, name)
+        checksum = hashlib.md5(data).hexdigest()
+        if checksum != segment['hash']:
+            raise Exception('Checksum validation failure of segment %s, '
+                            'actual: %s, expected: %s' %
+                            (name, checksum, segment['hash']))
+        return data
+
+    def _load_segments(self, segments):
+        """Yields the segments in order while downloading the next ones."""
+        with futures.ThreadPoolExecutor(self.concurrency) as executor:
+            window = [executor.submit(self._download_segment, segment)
+                      for segment in segments[:self.concurrency]]
+            for index in range(len(segments)):
+                data = window.pop(0).result()
+                next_index = index + self.concurrency
+                if next_index < len(segments):
+                    window.append(executor.submit(self._download_segment,
+                                                  segments[next_index]))
+                for offset in range(0, len(data), READ_CHUNK_SIZE):
+                    yield data[offset:offset + READ_CHUNK_SIZE]
+
+    def load(self, location, backup_checksum):
+        """Get object from the location, segments are loaded in parallel.
+
+        Objects which are not static large objects are streamed as
+        SwiftStorage does.
+        """
+        _, container, filename = self._explodeLocation(location)
+        headers = self.client.head_object(container, filename)
+        if backup_checksum:
+            self._verify_checksum(headers.get('etag', ''), backup_checksum)
+
+        if headers.get('x-static-large-object', '').lower() != 'true':
+            return super(K2hdkcSwiftStorage, self).load(location,
+                                                        backup_checksum)
+
+        _, manifest = self.client.get_object(
+            container, filename, query_string='multipart-manifest=get')
+        segments = json.loads(manifest)
+        LOG.info('Loading %s in %d segments, concurrency: %d', filename,
+                 len(segments), self.concurrency)
+        return self._load_segments(segments)
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: expandtab sw=4 ts=4 fdm=marker
+# vim<600: expandtab sw=4 ts=4
+#
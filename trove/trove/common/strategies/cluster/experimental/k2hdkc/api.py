@@ -19,18 +19,22 @@
 #
 """OpenStack Trove for K2HDKC."""
 
+from eventlet.greenpool import GreenPool
 from oslo_log import log as logging
 from trove.cluster import models
 from trove.cluster.tasks import ClusterTasks
 from trove.cluster.views import ClusterView
 from trove.common import cfg
+from trove.common import clients
 from trove.common import exception
 from trove.common import server_group as srv_grp
 from trove.common import utils
 from trove.common.strategies.cluster import base
 from trove.extensions.mgmt.clusters.views import MgmtClusterView
 from trove.instance import models as inst_models
+from trove.instance.tasks import InstanceTasks
 from trove.quota.quota import check_quotas
+from trove.quota.quota import run_with_quotas
 from trove.taskmanager import api as task_api
 
 LOG = logging.getLogger(__name__)
@@ -113,39 +117,91 @@ class K2hdkcCluster(models.Cluster):
             index += len(alls)
 
         # 3. Create instances
-        new_insts = []
+        #
+        # [NOTE]
+        # The names are decided before creating instances, so that the
+        # naming is the same as the sequential creation.
+        # Instances are created concurrently up to the configured width,
+        # and if one of them fails, all created instances are rolled back.
+        # See _USAGE_LOCK in trove.quota.quota for the quota usages.
+        #
         member_config = {"id": cluster_id, "instance_type": "member"}
-
         for instance in instances:
             if not instance.get('name'):
                 instance['name'] = "%s-member-%s" % (cluster_name, index)
                 index += 1
+
+        new_insts = [None] * num
+        errors = []
+
+        def _create_inst(position, instance):
             instance_name = instance.get('name')
             instance_az = instance.get('availability_zone', None)
             LOG.debug("new instance_name=%s instance_az=%s", instance_name,
                       instance_az)
-            new_inst = inst_models.Instance.create(
-                context,
-                instance_name,
-                instance['flavor_id'],
-                datastore_version.image_id,
-                [], [],
-                datastore,
-                datastore_version,
-                instance['volume_size'],
-                None,
-                nics=instance.get('nics', None),
-                availability_zone=instance_az,
-                configuration_id=configuration_id,
-                cluster_config=member_config,
-                volume_type=instance.get('volume_type', None),
-                modules=instance.get('modules'),
-                locality=locality,
-                region_name=instance.get('region_name'))
-
-            new_insts.append(new_inst)
+            try:
+                new_insts[position] = inst_models.Instance.create(
+                    context,
+                    instance_name,
+                    instance['flavor_id'],
+                    datastore_version.image_id,
+                    [], [],
+                    datastore,
+                    datastore_version,
+                    instance['volume_size'],
+                    None,
+                    nics=instance.get('nics', None),
+                    availability_zone=instance_az,
+                    configuration_id=configuration_id,
+                    cluster_config=member_config,
+                    volume_type=instance.get('volume_type', None),
+                    modules=instance.get('modules'),
+                    locality=locality,
+                    region_name=instance.get('region_name'))
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.error("Failed to create instance %s: %s", instance_name,
+                          exc)
+                errors.append(exc)
+
+        pool = GreenPool(size=max(1, manager_conf.create_instance_concurrency))
+        for position, instance in enumerate(instances):
+            pool.spawn_n(_create_inst, position, instance)
+        pool.waitall()
+
+        if errors:
+            K2hdkcCluster._rollback_insts(
+                context, [inst for inst in new_insts if inst],
+                manager_conf.volume_support)
+            raise errors[0]
         return new_insts
 
+    @staticmethod
+    def _rollback_insts(context, insts, volume_support):
+        """Deletes instances created by _create_insts.
+
+        The instances are still building, so Instance.delete can not be
+        used. This releases the quotas and asks the taskmanager to delete
+        the resources of each instance.
+        """
+        flavors = {}
+        for inst in insts:
+            LOG.warning("Rolling back instance %s", inst.id)
+            if inst.flavor_id not in flavors:
+                flavors[inst.flavor_id] = clients.create_nova_client(
+                    context).flavors.get(inst.flavor_id)
+            deltas = {'instances': -1, 'ram': -flavors[inst.flavor_id].ram}
+            if volume_support:
+                deltas['volumes'] = -inst.volume_size
+
+            def _delete_resources(inst=inst):
+                inst.db_info.update(task_status=InstanceTasks.DELETING)
+                task_api.API(context).delete_instance(inst.id)
+
+            try:
+                run_with_quotas(context.project_id, deltas, _delete_resources)
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.error("Failed to roll back instance %s: %s", inst.id, exc)
+
     @classmethod
     def create(cls, context, name, datastore, datastore_version, instances,
                extended_properties, locality, configuration, image_id
@@ -261,6 +317,15 @@ class K2hdkcCluster(models.Cluster):
 
         return True
 
+    def restart(self):
+        """Restart Cluster API endpoint.
+
+        The members are restarted by K2hdkcClusterTasks.restart_cluster,
+        at most k2hdkc.restart_concurrency members at a time.
+        """
+        LOG.debug("Restarting cluster %s", self.id)
+        return self.rolling_restart()
+
     def upgrade(self, datastore_version):   # pylint: disable=no-self-use
         """Return the source code for the definition."""
         LOG.debug("Upgrading cluster %s", datastore_version)
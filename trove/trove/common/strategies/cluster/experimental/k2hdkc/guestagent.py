@@ -56,6 +56,27 @@ class K2hdkcGuestAgentAPI(guest_api.API):   # pylint: disable=too-few-public-met
             LOG.error("unknown exception")
             raise
 
+    def service_out(self):
+        """Execute syncronously RPC service_out command."""
+        LOG.debug("Execute syncronously RPC service_out command.")
+        version = guest_api.API.API_BASE_VERSION
+        return self._call("service_out", self.agent_high_timeout,
+                          version=version)
+
+    def get_chmpx_status(self):
+        """Execute syncronously RPC get_chmpx_status command."""
+        LOG.debug("Execute syncronously RPC get_chmpx_status command.")
+        version = guest_api.API.API_BASE_VERSION
+        return self._call("get_chmpx_status", self.agent_low_timeout,
+                          version=version)
+
+    def get_reload_status(self):
+        """Execute syncronously RPC get_reload_status command."""
+        LOG.debug("Execute syncronously RPC get_reload_status command.")
+        version = guest_api.API.API_BASE_VERSION
+        return self._call("get_reload_status", self.agent_low_timeout,
+                          version=version)
+
 #
 # Local variables:
 # tab-width: 4
@@ -19,19 +19,32 @@
 #
 """OpenStack Clusters API taskmanager implementation."""
 
+import time
+
+import eventlet
+from eventlet.greenpool import GreenPool
 from eventlet.timeout import Timeout
+from novaclient import exceptions as nova_exceptions
 from oslo_log import log as logging
+from oslo_utils import netutils
+from oslo_utils import timeutils
 import trove.taskmanager.models as task_models
 from trove.common import cfg
+from trove.common import clients
+from trove.common import exception
 from trove.common.exception import GuestError, GuestTimeout
 from trove.common.strategies.cluster import base
+from trove.instance import service_status as srvstatus
 from trove.instance import tasks as inst_tasks
 from trove.instance.models import DBInstance
 from trove.instance.models import Instance
+from trove.instance.models import InstanceServiceStatus
 from trove.taskmanager import api as task_api
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
+# Maximum number of nova servers.get calls at the same time
+SERVER_LOAD_CONCURRENCY = 8
 
 
 class K2hdkcTaskManagerStrategy(base.BaseTaskManagerStrategy):
@@ -51,6 +64,309 @@ class K2hdkcTaskManagerStrategy(base.BaseTaskManagerStrategy):
 class K2hdkcClusterTasks(task_models.ClusterTasks):
     """Create Clusters API taskmanager endpoint."""
 
+    def _load_instances(self, context, instance_ids):
+        """Loads instances with a few bulk DB queries and API list calls.
+
+        The result is the same as Instance.load for each instance id, but
+        the DB rows, the service statuses and the neutron ports are fetched
+        at once instead of one by one. The nova servers are fetched by id in
+        parallel, because listing all servers of a large project is slower
+        than getting the few members.
+        """
+        if not instance_ids:
+            return []
+
+        db_infos = DBInstance.find_by_filter(
+            filters=[DBInstance.id.in_(instance_ids)], deleted=False).all()
+        db_info_map = {db_info.id: db_info for db_info in db_infos}
+        service_statuses = InstanceServiceStatus.find_by_filter(
+            filters=[InstanceServiceStatus.instance_id.in_(instance_ids)]
+        ).all()
+        service_status_map = {service_status.instance_id: service_status
+                              for service_status in service_statuses}
+
+        servers = {}
+        addresses = {}
+        for region_id in set(db_info.region_id for db_info in db_infos):
+            server_ids = [db_info.compute_instance_id for db_info in db_infos
+                          if db_info.region_id == region_id]
+            servers.update(
+                self._load_servers(context, region_id, server_ids))
+            addresses.update(
+                self._load_addresses(context, region_id, server_ids))
+
+        instances = []
+        for instance_id in instance_ids:
+            db_info = db_info_map.get(instance_id)
+            service_status = service_status_map.get(instance_id)
+            if db_info is None or service_status is None:
+                raise exception.NotFound(uuid=instance_id)
+            server = servers.get(db_info.compute_instance_id)
+            if server is None:
+                LOG.error("Could not load compute instance %s.",
+                          db_info.compute_instance_id)
+                raise exception.UnprocessableEntity(
+                    "Instance %s is not ready." % instance_id)
+            db_info.server_status = server.status
+            db_info.ports, db_info.addresses = addresses.get(
+                db_info.compute_instance_id, ([], []))
+            instances.append(Instance(context, db_info, server,
+                                      service_status))
+        LOG.debug("Loaded %d instances in bulk.", len(instances))
+        return instances
+
+    @staticmethod
+    def _load_servers(context, region_id, server_ids):
+        """Returns {server_id: server} of the servers which exist.
+
+        Only a missing server is skipped, the other nova errors are raised.
+        """
+        nova_client = clients.create_nova_client(context,
+                                                 region_name=region_id)
+
+        def _get(server_id):
+            try:
+                return server_id, nova_client.servers.get(server_id)
+            except nova_exceptions.NotFound:
+                LOG.debug("Compute instance %s is not found.", server_id)
+                return server_id, None
+
+        pool = GreenPool(size=SERVER_LOAD_CONCURRENCY)
+        return {server_id: server
+                for server_id, server in pool.imap(_get, server_ids)
+                if server is not None}
+
+    @staticmethod
+    def _load_addresses(context, region_id, server_ids):
+        """Returns {server_id: (user_ports, addresses)} for the servers.
+
+        This is the bulk version of load_simple_instance_addresses in
+        trove.instance.models, so the rules of the addresses are the same.
+        """
+        result = {server_id: ([], []) for server_id in server_ids}
+        if not server_ids:
+            return result
+        neutron_client = clients.create_neutron_client(context, region_id)
+        ports = neutron_client.list_ports(device_id=server_ids)['ports']
+        user_ports = [port for port in ports
+                      if port['network_id'] not in CONF.management_networks]
+        fips = {}
+        if user_ports:
+            for fip in neutron_client.list_floatingips(
+                    port_id=[port['id'] for port in user_ports]
+            )['floatingips']:
+                fips.setdefault(fip['port_id'], fip)
+
+        for port in user_ports:
+            port_ids, addresses = result[port['device_id']]
+            port_ids.append(port['id'])
+            for ip in port['fixed_ips']:
+                if netutils.is_valid_ipv4(ip.get('ip_address')):
+                    addresses.append({'address': ip['ip_address'],
+                                      'type': 'private',
+                                      'network': port['network_id']})
+            if port['id'] in fips:
+                addresses.append(
+                    {'address': fips[port['id']]['floating_ip_address'],
+                     'type': 'public'})
+        return result
+
+    def _wait_for_instances_healthy(self, instance_ids, cluster_id,
+                                    status=None, update_on_failure=True,
+                                    updated_since=None):
+        """Waits for all instances to become HEALTHY.
+
+        This replaces _all_instances_healthy of ClusterTasks. All members
+        are checked with one query per poll, and the poll interval grows
+        exponentially while no member changes. It stops as soon as any
+        member fails, and logs the time to become HEALTHY of each member.
+        The task status of the members is set to status on failure unless
+        update_on_failure is false. If updated_since is given, a HEALTHY
+        status written before that time is not counted, so the status
+        reported before a restart does not end the wait.
+        """
+        fast_fail_statuses = [srvstatus.ServiceStatuses.FAILED,
+                              srvstatus.ServiceStatuses.FAILED_TIMEOUT_GUESTAGENT]
+        initial_interval = CONF.k2hdkc.healthy_poll_initial_interval
+        max_interval = max(initial_interval,
+                           CONF.k2hdkc.healthy_poll_max_interval)
+        pending_ids = set(instance_ids)
+        time_to_healthy = {}
+        interval = initial_interval
+        started = time.monotonic()
+
+        LOG.debug("Waiting for instances to become HEALTHY: %s", instance_ids)
+        while pending_ids:
+            service_statuses = InstanceServiceStatus.find_by_filter(
+                filters=[InstanceServiceStatus.instance_id.in_(list(pending_ids))]
+            ).all()
+            task_statuses = {
+                db_info.id: db_info.get_task_status()
+                for db_info in DBInstance.find_by_filter(
+                    filters=[DBInstance.id.in_(list(pending_ids))]).all()}
+            elapsed = time.monotonic() - started
+
+            failed_ids = []
+            progressed = False
+            for service_status in service_statuses:
+                instance_id = service_status.instance_id
+                current = service_status.get_status()
+                if (current in fast_fail_statuses or
+                        task_statuses.get(instance_id) ==
+                        inst_tasks.InstanceTasks.BUILDING_ERROR_SERVER):
+                    failed_ids.append(instance_id)
+                elif (current == srvstatus.ServiceStatuses.HEALTHY and
+                      (updated_since is None or
+                       service_status.updated_at >= updated_since)):
+                    time_to_healthy[instance_id] = elapsed
+                    pending_ids.discard(instance_id)
+                    progressed = True
+                    LOG.info("Instance %s became HEALTHY in %.1f seconds.",
+                             instance_id, elapsed)
+
+            if failed_ids:
+                LOG.error("Some instances failed: %s", failed_ids)
+                if update_on_failure:
+                    self.update_statuses_on_failure(cluster_id, status=status)
+                return False
+            if not pending_ids:
+                break
+            if elapsed >= CONF.usage_timeout:
+                LOG.error("Timed out while waiting for instances to become "
+                          "HEALTHY: %s", sorted(pending_ids))
+                if update_on_failure:
+                    self.update_statuses_on_failure(cluster_id, status=status)
+                return False
+
+            # Poll again soon if some member became HEALTHY in this round.
+            if progressed:
+                interval = initial_interval
+            eventlet.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+        LOG.info("All instances became HEALTHY in %.1f seconds: %s",
+                 time.monotonic() - started, time_to_healthy)
+        return True
+
+    def _call_instances(self, func, instances, concurrency):
+        """Calls func for each instance with bounded concurrency.
+
+        Returns a tuple of dicts, the results and the errors keyed by
+        instance id. A failure of one instance does not stop the others,
+        and each failure is logged here, so the callers do not log it.
+        """
+        results = {}
+        errors = {}
+
+        def _call(instance):
+            try:
+                results[instance.id] = func(instance)
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.error("Failed on instance %s: %s", instance.id, exc)
+                errors[instance.id] = exc
+
+        pool = GreenPool(size=max(1, concurrency))
+        for instance in instances:
+            pool.spawn_n(_call, instance)
+        pool.waitall()
+        return results, errors
+
+    def _cluster_complete(self, instances):
+        """Calls cluster_complete endpoint of K2hdkcGuestAgent in parallel.
+
+        Returns true if all instances succeeded.
+        """
+        _results, errors = self._call_instances(
+            lambda instance: self.get_guest(instance).cluster_complete(),
+            instances, CONF.k2hdkc.cluster_complete_concurrency)
+        return not errors
+
+    def _drain_instances(self, removing, remaining):
+        """Services out the removing members and waits for the ring.
+
+        Returns true when all removing members are SERVICE OUT and no
+        member is merging or suspended, that is the data of the removing
+        members is on the remaining members. The progress is logged on
+        each poll.
+        """
+        concurrency = CONF.k2hdkc.cluster_complete_concurrency
+        _results, errors = self._call_instances(
+            lambda instance: self.get_guest(instance).service_out(),
+            removing, concurrency)
+        if errors:
+            LOG.error("Failed to service out members %s", sorted(errors))
+            return False
+
+        removing_ids = set(instance.id for instance in removing)
+        initial_interval = CONF.k2hdkc.healthy_poll_initial_interval
+        max_interval = max(initial_interval,
+                           CONF.k2hdkc.healthy_poll_max_interval)
+        interval = initial_interval
+        started = time.monotonic()
+        while True:
+            statuses, errors = self._call_instances(
+                lambda instance: self.get_guest(instance).get_chmpx_status(),
+                removing + remaining, concurrency)
+            elapsed = time.monotonic() - started
+            drained_ids = [
+                instance_id for instance_id in removing_ids
+                if instance_id in statuses and
+                not statuses[instance_id]['service_in'] and
+                not statuses[instance_id]['merging'] and
+                not statuses[instance_id]['suspended']]
+            busy_ids = [instance_id
+                        for instance_id, status in statuses.items()
+                        if instance_id not in removing_ids and
+                        (status['merging'] or status['suspended'])]
+            LOG.info("Draining %d/%d members in %.0f seconds, merging or "
+                     "suspended members: %s, unknown members: %s",
+                     len(drained_ids), len(removing_ids), elapsed,
+                     sorted(busy_ids), sorted(errors))
+            if (len(drained_ids) == len(removing_ids) and not busy_ids and
+                    not errors):
+                LOG.info("Drained members %s in %.1f seconds.",
+                         sorted(removing_ids), elapsed)
+                return True
+            if elapsed >= CONF.k2hdkc.shrink_drain_timeout:
+                LOG.error("Timed out while draining members %s, members "
+                          "not drained: %s", sorted(removing_ids),
+                          sorted(removing_ids.difference(drained_ids)))
+                return False
+            eventlet.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    def _serviced_in_instances(self, instances):
+        """Returns the ids of the members which may be in the ring.
+
+        A member whose CHMPX status can not be read is also returned.
+        """
+        statuses, errors = self._call_instances(
+            lambda instance: self.get_guest(instance).get_chmpx_status(),
+            instances, CONF.k2hdkc.cluster_complete_concurrency)
+        return sorted(
+            [instance_id for instance_id, status in statuses.items()
+             if status['service_in']] + list(errors))
+
+    def _delete_instances(self, instances):
+        """Deletes the instances with bounded concurrency.
+
+        A failure of one instance does not stop the others, and the ids
+        of all failed instances are logged together. Returns the errors
+        keyed by instance id. See _USAGE_LOCK in trove.quota.quota for
+        the quota released by each Instance.delete.
+        """
+        started = time.monotonic()
+        _results, errors = self._call_instances(
+            Instance.delete, instances,
+            CONF.k2hdkc.delete_instance_concurrency)
+        LOG.info("Deleted %d of %d instances in %.1f seconds.",
+                 len(instances) - len(errors), len(instances),
+                 time.monotonic() - started)
+        if errors:
+            LOG.error("Failed to delete %d instances: %s", len(errors),
+                      sorted(errors))
+        return errors
+
     def create_cluster(self, context, cluster_id):
         """Create K2hdkcClusterTasks.
 
@@ -78,21 +394,20 @@ class K2hdkcClusterTasks(task_models.ClusterTasks):
             instance_ids = [db_instance.id for db_instance in db_instances]
 
             # 4. Checks if instances are ready
-            if not self._all_instances_healthy(instance_ids, cluster_id):
+            if not self._wait_for_instances_healthy(instance_ids, cluster_id):
                 LOG.error("instances are not ready yet")
                 return
 
             # 5. Loads instances
-            instances = [
-                Instance.load(context, instance_id)
-                for instance_id in instance_ids
-            ]
+            instances = self._load_instances(context, instance_ids)
 
             # 6. Instantiates GuestAgent for each guest instance
 
             # 7. Calls cluster_complete endpoint of K2hdkcGuestAgent
-            for instance in instances:
-                self.get_guest(instance).cluster_complete()
+            if not self._cluster_complete(instances):
+                LOG.error("cluster_complete failed on some instances")
+                self.update_statuses_on_failure(cluster_id)
+                return
 
             # 8. reset the current cluster task status to None
             LOG.debug("reset cluster task to None")
@@ -134,23 +449,25 @@ class K2hdkcClusterTasks(task_models.ClusterTasks):
             LOG.debug("len(db_instances) {}".format(len(db_instances)))
 
             # 3. Checks if new instances are ready
-            if not self._all_instances_healthy(new_instance_ids, cluster_id):
+            if not self._wait_for_instances_healthy(
+                    new_instance_ids, cluster_id,
+                    status=inst_tasks.InstanceTasks.GROWING_ERROR):
                 LOG.error("instances are not ready yet")
                 return
 
             # 4. Loads instances
-            instances = [
-                Instance.load(context, instance_id)
-                for instance_id in new_instance_ids
-            ]
+            instances = self._load_instances(context, new_instance_ids)
             LOG.debug("len(instances) {}".format(len(instances)))
 
             # 5. Instances GuestAgent class
 
             # 6. Calls cluster_complete endpoint of K2hdkcGuestAgent
             LOG.debug("Calling cluster_complete as a final hook to each node in the cluster")
-            for instance in instances:
-                self.get_guest(instance).cluster_complete()
+            if not self._cluster_complete(instances):
+                LOG.error("cluster_complete failed on some instances")
+                self.update_statuses_on_failure(
+                    cluster_id, status=inst_tasks.InstanceTasks.GROWING_ERROR)
+                return
 
             # 7. reset the current cluster task status to None
             LOG.debug("reset cluster task to None")
@@ -195,33 +512,52 @@ class K2hdkcClusterTasks(task_models.ClusterTasks):
             instance_ids = [db_instance.id for db_instance in db_instances]
 
             # 4. Checks if instances are running
-            if not self._all_instances_healthy(instance_ids, cluster_id):
+            if not self._wait_for_instances_healthy(
+                    instance_ids, cluster_id,
+                    status=inst_tasks.InstanceTasks.SHRINKING_ERROR):
                 LOG.error("instances are not ready yet")
                 return
 
             # 5. Loads instances
-            instances = [
-                Instance.load(context, instance_id)
-                for instance_id in removal_ids
-            ]
+            all_instances = self._load_instances(context, instance_ids)
+            instances = [instance for instance in all_instances
+                         if instance.id in removal_ids]
+            remaining = [instance for instance in all_instances
+                         if instance.id not in removal_ids]
+            unknown_ids = set(removal_ids).difference(instance_ids)
+            if unknown_ids:
+                raise exception.NotFound(uuid=", ".join(sorted(unknown_ids)))
             LOG.debug("len(instances) {}".format(len(instances)))
 
-            # 6. Instances GuestAgent class
-
-            # 6.2. Checks if removing instances are 
-            # if not self._all_instances_shutdown(removal_ids, cluster_id):
-            #    LOG.error("removing instances are not shutdown yet")
-            #    return
+            # 6. Drains the removing instances, so no key is lost
+            if not self._drain_instances(instances, remaining):
+                LOG.error("removing instances are not drained")
+                self.update_statuses_on_failure(
+                    cluster_id, status=inst_tasks.InstanceTasks.SHRINKING_ERROR)
+                return
 
             # 7. Calls cluster_complete endpoint of K2hdkcGuestAgent
             LOG.debug("Calling cluster_complete as a final hook to each node in the cluster")
-            for instance in instances:
-                self.get_guest(instance).cluster_complete()
+            if not self._cluster_complete(instances):
+                LOG.error("cluster_complete failed on some instances")
+                self.update_statuses_on_failure(
+                    cluster_id, status=inst_tasks.InstanceTasks.SHRINKING_ERROR)
+                return
 
-            # 8. delete node from OpenStack
+            # 8. delete node from OpenStack in parallel, after checking
+            #    that no removing node has joined the ring again
+            serviced_in_ids = self._serviced_in_instances(instances)
+            if serviced_in_ids:
+                LOG.error("removing instances are not SERVICE OUT: %s",
+                          serviced_in_ids)
+                self.update_statuses_on_failure(
+                    cluster_id, status=inst_tasks.InstanceTasks.SHRINKING_ERROR)
+                return
             LOG.debug("delete node from OpenStack")
-            for instance in instances:
-                Instance.delete(instance)
+            if self._delete_instances(instances):
+                self.update_statuses_on_failure(
+                    cluster_id, status=inst_tasks.InstanceTasks.SHRINKING_ERROR)
+                return
 
             # 9. reset the current cluster task status to None
             LOG.debug("reset cluster task to None")
@@ -240,6 +576,95 @@ class K2hdkcClusterTasks(task_models.ClusterTasks):
 
         LOG.debug("Completed shrink_cluster for %s.", cluster_id)
 
+    def _restart_instance(self, instance):
+        """Restarts the database of one member, and returns the seconds."""
+        started = time.monotonic()
+        instance.update_db(task_status=inst_tasks.InstanceTasks.REBOOTING)
+        try:
+            self.get_guest(instance).restart()
+        finally:
+            instance.update_db(task_status=inst_tasks.InstanceTasks.NONE)
+        return time.monotonic() - started
+
+    @staticmethod
+    def _mark_restart_failed(instance_ids):
+        """Sets RESTART_REQUIRED to the members which failed to restart."""
+        for db_instance in DBInstance.find_by_filter(
+                filters=[DBInstance.id.in_(list(instance_ids))]).all():
+            db_instance.set_task_status(
+                inst_tasks.InstanceTasks.RESTART_REQUIRED)
+            db_instance.save()
+
+    def restart_cluster(self, context, cluster_id):
+        """Restart a K2hdkc Cluster in rolling batches.
+
+        At most k2hdkc.restart_concurrency members are restarted at the
+        same time, and the next batch starts only after all members of the
+        batch become HEALTHY again, so the other members keep serving.
+        The rolling restart stops at the first batch which fails, and the
+        failed members are left in RESTART_REQUIRED so the operator can see
+        where it stopped.
+        """
+        LOG.debug("Begins restart_cluster for %s.", cluster_id)
+
+        # 1. validates args
+        if context is None:
+            LOG.error("no context")
+            return
+        if cluster_id is None:
+            LOG.error("no cluster_id")
+            return
+
+        concurrency = max(1, CONF.k2hdkc.restart_concurrency)
+        batch_ids = []
+        timeout = Timeout(CONF.cluster_usage_timeout)
+        try:
+            # 2. Retrieves instance ids from the database
+            db_instances = DBInstance.find_all(cluster_id=cluster_id,
+                                               deleted=False).all()
+            instance_ids = [db_instance.id for db_instance in db_instances]
+
+            # 3. Restarts each batch and waits for it to become HEALTHY
+            for start in range(0, len(instance_ids), concurrency):
+                batch_ids = instance_ids[start:start + concurrency]
+                LOG.info("Restarting members %d-%d of %d: %s", start + 1,
+                         start + len(batch_ids), len(instance_ids),
+                         batch_ids)
+                batch_started = time.monotonic()
+                restarted_at = timeutils.utcnow()
+                instances = self._load_instances(context, batch_ids)
+                restart_times, errors = self._call_instances(
+                    self._restart_instance, instances, concurrency)
+                if errors:
+                    self._mark_restart_failed(errors)
+                    raise exception.TroveError(
+                        "Failed to restart members %s, the rolling restart "
+                        "is stopped." % sorted(errors))
+                if not self._wait_for_instances_healthy(
+                        batch_ids, cluster_id, update_on_failure=False,
+                        updated_since=restarted_at):
+                    self._mark_restart_failed(batch_ids)
+                    raise exception.TroveError(
+                        "Restarted members %s did not become HEALTHY, the "
+                        "rolling restart is stopped." % batch_ids)
+                LOG.info("Members %s are HEALTHY again in %.1f seconds, "
+                         "restart took %s.", batch_ids,
+                         time.monotonic() - batch_started, restart_times)
+
+        except Timeout as t:
+            if t is not timeout:
+                raise  # not my timeout
+            LOG.exception("Timeout for restarting cluster.")
+            self._mark_restart_failed(batch_ids)
+            raise
+
+        finally:
+            timeout.cancel()
+            # 4. reset the current cluster task status to None
+            self.reset_task()
+
+        LOG.debug("Completed restart_cluster for %s.", cluster_id)
+
 
 class K2hdkcTaskManagerAPI(task_api.API):   # pylint: disable=too-few-public-methods
     """OpenStack Clusters API taskmanager API class implementation."""
@@ -17,6 +17,11 @@
 Model classes that extend the instances functionality for K2HDKC instances.
 """
 
+import collections
+import functools
+import threading
+import time
+
 from trove.common import cfg
 from trove.common.clients import create_guest_client
 from trove.common.db.k2hdkc import models as guest_models
@@ -33,9 +38,81 @@ def persisted_models():
     return {'root_enabled_history': RootHistory}
 
 
+class ListingCache(object):
+    """LRU cache of the users and schemas listings of the instances.
+
+    The key is (listing, instance_id, tenant, marker, limit). A listing
+    loaded before an invalidation of its instance is not stored, so a
+    change made during the guest call is never hidden by the cache.
+    """
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, instance_id):
+        with self._lock:
+            return self._generations.get(instance_id, 0)
+
+    def get(self, key):
+        ttl = CONF.k2hdkc.listing_cache_ttl
+        if ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            loaded_at, value = entry
+            if time.monotonic() - loaded_at > ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, generation):
+        if CONF.k2hdkc.listing_cache_ttl <= 0:
+            return
+        with self._lock:
+            if self._generations.get(key[1], 0) != generation:
+                return
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > CONF.k2hdkc.listing_cache_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, instance_id):
+        with self._lock:
+            self._generations[instance_id] = (
+                self._generations.get(instance_id, 0) + 1)
+            for key in [key for key in self._entries
+                        if key[1] == instance_id]:
+                del self._entries[key]
+
+
+_listing_cache = ListingCache()
+
+
+@functools.lru_cache(maxsize=None)
+def _ignored_users():
+    """Returns the ignored user names, computed once per process."""
+    return frozenset(cfg.get_ignored_users())
+
+
+@functools.lru_cache(maxsize=None)
+def _ignored_dbs():
+    """Returns the ignored schema names, computed once per process."""
+    return frozenset(cfg.get_ignored_dbs())
+
+
+def _visible(rows, ignored):
+    """Yields the serialized guest rows whose names are not ignored."""
+    return (row for row in rows if row['_name'] not in ignored)
+
+
 class User(object):
 
-    _data_fields = ['name', 'host', 'password', 'databases']
+    __slots__ = ('name', 'host', 'password', 'databases')
 
     def __init__(self, name, host, password, databases):
         self.name = name
@@ -43,19 +120,32 @@ class User(object):
         self.password = password
         self.databases = databases
 
+    def view_data(self):
+        return {'name': self.name,
+                'host': self.host,
+                'databases': self.databases}
+
     @classmethod
-    def load(cls, context, instance_id, username, hostname, root_user=False):
+    def load(cls, context, instance_id, username, hostname, root_user=False,
+             validate=True):
+        """Returns the user or None.
+
+        validate=False skips the name checks for a caller which has
+        already validated the user.
+        """
         load_and_verify(context, instance_id)
-        validate = guest_models.K2hdkcUser(name=username, host=hostname)
-        if root_user:
-            validate.make_root()
-        validate.check_reserved()
+        if validate:
+            guest_user = guest_models.K2hdkcUser(name=username,
+                                                 host=hostname)
+            if root_user:
+                guest_user.make_root()
+            guest_user.check_reserved()
         client = create_guest_client(context, instance_id)
         found_user = client.get_user(username=username, hostname=hostname)
         if not found_user:
             return None
         database_names = [{'name': db['_name']}
-                          for db in found_user['_databases']]
+                          for db in found_user.get('_databases', [])]
         return cls(found_user['_name'],
                    found_user['_host'],
                    found_user['_password'],
@@ -66,21 +156,34 @@ class User(object):
         # Load InstanceServiceStatus to verify if it's running
         load_and_verify(context, instance_id)
         client = create_guest_client(context, instance_id)
+        # Load the existing users once and check all users in memory
+        # instead of one guest call per user.
+        existing_users = set((str(user.name), str(user.host))
+                             for user in Users.load_all_with_client(client))
         for user in users:
             user_name = user['_name']
             host_name = user['_host']
-            userhost = "%s@%s" % (user_name, host_name)
-            existing_users, _nadda = Users.load_with_client(
-                client,
-                limit=1,
-                marker=userhost,
-                include_marker=True)
-            if (len(existing_users) > 0 and
-                    str(existing_users[0].name) == str(user_name) and
-                    str(existing_users[0].host) == str(host_name)):
+            if (str(user_name), str(host_name)) in existing_users:
                 raise exception.UserAlreadyExists(name=user_name,
                                                   host=host_name)
-        return client.create_user(users)
+        try:
+            return client.create_user(users)
+        finally:
+            _listing_cache.invalidate(instance_id)
+
+    @classmethod
+    def find_missing(cls, context, instance_id, users):
+        """Returns the users which do not exist on the instance.
+
+        All users are verified by one listing instead of one get_user call
+        per user.
+        """
+        load_and_verify(context, instance_id)
+        client = create_guest_client(context, instance_id)
+        existing_users = set((str(user.name), str(user.host))
+                             for user in Users.load_all_with_client(client))
+        return [user for user in users
+                if (str(user.name), str(user.host)) not in existing_users]
 
     @classmethod
     def delete(cls, context, instance_id, user):
@@ -88,7 +191,10 @@ class User(object):
 
         with StartNotification(context, instance_id=instance_id,
                                username=user):
-            create_guest_client(context, instance_id).delete_user(user)
+            try:
+                create_guest_client(context, instance_id).delete_user(user)
+            finally:
+                _listing_cache.invalidate(instance_id)
 
     @classmethod
     def access(cls, context, instance_id, username, hostname):
@@ -106,13 +212,19 @@ class User(object):
     def grant(cls, context, instance_id, username, hostname, databases):
         load_and_verify(context, instance_id)
         client = create_guest_client(context, instance_id)
-        client.grant_access(username, hostname, databases)
+        try:
+            client.grant_access(username, hostname, databases)
+        finally:
+            _listing_cache.invalidate(instance_id)
 
     @classmethod
     def revoke(cls, context, instance_id, username, hostname, database):
         load_and_verify(context, instance_id)
         client = create_guest_client(context, instance_id)
-        client.revoke_access(username, hostname, database)
+        try:
+            client.revoke_access(username, hostname, database)
+        finally:
+            _listing_cache.invalidate(instance_id)
 
     @classmethod
     def change_password(cls, context, instance_id, users):
@@ -125,7 +237,10 @@ class User(object):
                            'password': user.password,
                            }
             change_users.append(change_user)
-        client.change_passwords(change_users)
+        try:
+            client.change_passwords(change_users)
+        finally:
+            _listing_cache.invalidate(instance_id)
 
     @classmethod
     def update_attributes(cls, context, instance_id, username, hostname,
@@ -154,24 +269,50 @@ class User(object):
                     existing_users[0].host == host):
                 raise exception.UserAlreadyExists(name=user,
                                                   host=host)
-        client.update_attributes(username, hostname, user_attrs)
+        try:
+            client.update_attributes(username, hostname, user_attrs)
+        finally:
+            _listing_cache.invalidate(instance_id)
 
 
 class UserAccess(object):
-    _data_fields = ['databases']
+
+    __slots__ = ('databases',)
 
     def __init__(self, databases):
         self.databases = databases
 
+    def view_data(self):
+        return {'databases': [schema.view_data()
+                              for schema in self.databases]}
+
 
 def load_via_context(cls, context, instance_id):
-    """Creates guest and fetches pagination arguments from the context."""
-    load_and_verify(context, instance_id)
+    """Creates guest and fetches pagination arguments from the context.
+
+    Returns the page as a tuple of view-ready dicts. The page is cached
+    for CONF.k2hdkc.listing_cache_ttl seconds, a cached page needs no
+    guest call but the instance is still checked.
+    Each API worker has its own cache, so a page of another worker may be
+    stale for up to the ttl after a change. This is accepted by enabling
+    the cache.
+    """
     limit = utils.pagination_limit(context.limit, cls.DEFAULT_LIMIT)
+    key = (cls.__name__, instance_id, context.project_id, context.marker,
+           limit)
+    generation = _listing_cache.generation(instance_id)
+    load_and_verify(context, instance_id)
+    cached = _listing_cache.get(key)
+    if cached is not None:
+        return cached
     client = create_guest_client(context, instance_id)
     # The REST API standard dictates that we *NEVER* include the marker.
-    return cls.load_with_client(client=client, limit=limit,
-                                marker=context.marker, include_marker=False)
+    rows, next_marker = cls.load_rows_with_client(
+        client=client, limit=limit, marker=context.marker,
+        include_marker=False)
+    result = (tuple(rows), next_marker)
+    _listing_cache.put(key, result, generation)
+    return result
 
 
 class Users(object):
@@ -188,53 +329,86 @@ class Users(object):
             limit=limit,
             marker=marker,
             include_marker=include_marker)
-        model_users = []
-        for user in user_list:
-            k2hdkc_user = guest_models.K2hdkcUser.deserialize(user,
-                                                            verify=False)
-            if k2hdkc_user.name in cfg.get_ignored_users():
-                continue
-            # TODO(hub-cap): databases are not being returned in the
-            # reference agent
-            dbs = []
-            for db in k2hdkc_user.databases:
-                dbs.append({'name': db['_name']})
-            model_users.append(User(k2hdkc_user.name,
-                                    k2hdkc_user.host,
-                                    k2hdkc_user.password,
-                                    dbs))
+        model_users = [User(user['_name'],
+                            user['_host'],
+                            user['_password'],
+                            [{'name': db['_name']}
+                             for db in user.get('_databases', [])])
+                       for user in _visible(user_list, _ignored_users())]
         return model_users, next_marker
 
+    @classmethod
+    def load_rows_with_client(cls, client, limit, marker, include_marker):
+        """Returns a generator of view-ready user dicts and the marker.
+
+        Ignored users are dropped before anything is built for them.
+        """
+        user_list, next_marker = client.list_users(
+            limit=limit,
+            marker=marker,
+            include_marker=include_marker)
+        rows = ({'name': user['_name'],
+                 'host': user['_host'],
+                 'databases': [{'name': db['_name']}
+                               for db in user.get('_databases', [])]}
+                for user in _visible(user_list, _ignored_users()))
+        return rows, next_marker
+
+    @classmethod
+    def load_all_with_client(cls, client):
+        """Returns all users of the instance.
+
+        The guest returns all users when no limit is given, so this is one
+        guest call unless the guest pages the result.
+        """
+        all_users = []
+        marker = None
+        while True:
+            users, marker = cls.load_with_client(client, limit=None,
+                                                 marker=marker,
+                                                 include_marker=False)
+            all_users.extend(users)
+            if not marker:
+                return all_users
+
 
 class Schema(object):
 
-    _data_fields = ['name', 'collate', 'character_set']
+    __slots__ = ('name', 'collate', 'character_set')
 
     def __init__(self, name, collate, character_set):
         self.name = name
         self.collate = collate
         self.character_set = character_set
 
+    def view_data(self):
+        return {'name': self.name}
+
     @classmethod
     def create(cls, context, instance_id, schemas):
         load_and_verify(context, instance_id)
         client = create_guest_client(context, instance_id)
+        # Load the existing schemas once and check all schemas in memory
+        # instead of one guest call per schema.
+        existing_schemas = set(
+            str(schema.name)
+            for schema in Schemas.load_all_with_client(client))
         for schema in schemas:
             schema_name = schema['_name']
-            existing_schema, _nadda = Schemas.load_with_client(
-                client,
-                limit=1,
-                marker=schema_name,
-                include_marker=True)
-            if (len(existing_schema) > 0 and
-                    str(existing_schema[0].name) == str(schema_name)):
+            if str(schema_name) in existing_schemas:
                 raise exception.DatabaseAlreadyExists(name=schema_name)
-        return client.create_database(schemas)
+        try:
+            return client.create_database(schemas)
+        finally:
+            _listing_cache.invalidate(instance_id)
 
     @classmethod
     def delete(cls, context, instance_id, schema):
         load_and_verify(context, instance_id)
-        create_guest_client(context, instance_id).delete_database(schema)
+        try:
+            create_guest_client(context, instance_id).delete_database(schema)
+        finally:
+            _listing_cache.invalidate(instance_id)
 
 
 class Schemas(object):
@@ -251,17 +425,43 @@ class Schemas(object):
             limit=limit,
             marker=marker,
             include_marker=include_marker)
-        model_schemas = []
-        for schema in schemas:
-            k2hdkc_schema = guest_models.K2hdkcSchema.deserialize(schema,
-                                                                verify=False)
-            if k2hdkc_schema.name in cfg.get_ignored_dbs():
-                continue
-            model_schemas.append(Schema(k2hdkc_schema.name,
-                                        k2hdkc_schema.collate,
-                                        k2hdkc_schema.character_set))
+        model_schemas = [Schema(schema['_name'],
+                                schema['_collate'],
+                                schema['_character_set'])
+                         for schema in _visible(schemas, _ignored_dbs())]
         return model_schemas, next_marker
 
+    @classmethod
+    def load_rows_with_client(cls, client, limit, marker, include_marker):
+        """Returns a generator of view-ready schema dicts and the marker.
+
+        Ignored schemas are dropped before anything is built for them.
+        """
+        schemas, next_marker = client.list_databases(
+            limit=limit,
+            marker=marker,
+            include_marker=include_marker)
+        rows = ({'name': schema['_name']}
+                for schema in _visible(schemas, _ignored_dbs()))
+        return rows, next_marker
+
+    @classmethod
+    def load_all_with_client(cls, client):
+        """Returns all schemas of the instance.
+
+        The guest returns all schemas when no limit is given, so this is
+        one guest call unless the guest pages the result.
+        """
+        all_schemas = []
+        marker = None
+        while True:
+            schemas, marker = cls.load_with_client(client, limit=None,
+                                                   marker=marker,
+                                                   include_marker=False)
+            all_schemas.extend(schemas)
+            if not marker:
+                return all_schemas
+
     @classmethod
     def find(cls, context, instance_id, schema_id):
         load_and_verify(context, instance_id)
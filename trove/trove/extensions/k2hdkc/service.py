@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from urllib.parse import unquote
 
 from oslo_log import log as logging
 from oslo_utils import importutils
@@ -111,6 +112,41 @@ def unquote_user_host(user_hostname):
     user = '@'.join(splitup[:-1])
     return user, host
 
+
+class UserIdentity(object):
+    """The user named by the id of a request, parsed once per request.
+
+    The validation and the guest lookup are memoized, so the steps of
+    one action share one parse, one check_reserved and one User.load.
+    ValueError and AttributeError are raised as the models raise them,
+    each action reports them with its own message.
+    """
+
+    def __init__(self, req, user_id):
+        self.id = correct_id_with_req(user_id, req)
+        self.name, self.host = unquote_user_host(self.id)
+        self._guest_user = None
+        self._loaded = False
+        self._user = None
+
+    def guest_user(self):
+        """Returns the validated K2hdkcUser of this identity."""
+        if self._guest_user is None:
+            guest_user = guest_models.K2hdkcUser(name=self.name,
+                                                 host=self.host)
+            guest_user.check_reserved()
+            self._guest_user = guest_user
+        return self._guest_user
+
+    def load(self, context, instance_id):
+        """Returns the user on the instance, None if it does not exist."""
+        if not self._loaded:
+            self.guest_user()
+            self._user = models.User.load(context, instance_id, self.name,
+                                          self.host, validate=False)
+            self._loaded = True
+        return self._user
+
 ###--------------------------------------------------------------------------------------
 
 
@@ -169,26 +205,20 @@ class UserController(ExtensionController):
                  {"id": instance_id, "req": req})
         context = req.environ[wsgi.CONTEXT_KEY]
         self.authorize_target_action(context, 'user:delete', instance_id)
-        id = correct_id_with_req(id, req)
-        username, host = unquote_user_host(id)
-        user = None
+        identity = UserIdentity(req, id)
         context.notification = notification.DBaaSUserDelete(context,
                                                             request=req)
         with StartNotification(context, instance_id=instance_id,
-                               username=username):
+                               username=identity.name):
             try:
-                user = guest_models.K2hdkcUser(name=username,
-                                              host=host)
-                found_user = models.User.load(context, instance_id, username,
-                                              host)
-                if not found_user:
-                    user = None
+                found_user = identity.load(context, instance_id)
             except (ValueError, AttributeError) as e:
                 raise exception.BadRequest(_("User delete error: %(e)s")
                                            % {'e': e})
-            if not user:
-                raise exception.UserNotFound(uuid=id)
-            models.User.delete(context, instance_id, user.serialize())
+            if not found_user:
+                raise exception.UserNotFound(uuid=identity.id)
+            models.User.delete(context, instance_id,
+                               identity.guest_user().serialize())
         return wsgi.Result(None, 202)
 
     def show(self, req, tenant_id, instance_id, id):
@@ -198,16 +228,14 @@ class UserController(ExtensionController):
                  {"id": instance_id, "req": req})
         context = req.environ[wsgi.CONTEXT_KEY]
         self.authorize_target_action(context, 'user:show', instance_id)
-        id = correct_id_with_req(id, req)
-        username, host = unquote_user_host(id)
-        user = None
+        identity = UserIdentity(req, id)
         try:
-            user = models.User.load(context, instance_id, username, host)
+            user = identity.load(context, instance_id)
         except (ValueError, AttributeError) as e:
             raise exception.BadRequest(_("User show error: %(e)s")
                                        % {'e': e})
         if not user:
-            raise exception.UserNotFound(uuid=id)
+            raise exception.UserNotFound(uuid=identity.id)
         view = views.UserView(user)
         return wsgi.Result(view.data(), 200)
 
@@ -218,25 +246,23 @@ class UserController(ExtensionController):
                  {"id": instance_id, "req": strutils.mask_password(req)})
         context = req.environ[wsgi.CONTEXT_KEY]
         self.authorize_target_action(context, 'user:update', instance_id)
-        id = correct_id_with_req(id, req)
-        username, hostname = unquote_user_host(id)
-        user = None
+        identity = UserIdentity(req, id)
         user_attrs = body['user']
         context.notification = notification.DBaaSUserUpdateAttributes(
             context, request=req)
         with StartNotification(context, instance_id=instance_id,
-                               username=username):
+                               username=identity.name):
             try:
-                user = models.User.load(context, instance_id, username,
-                                        hostname)
+                user = identity.load(context, instance_id)
             except (ValueError, AttributeError) as e:
                 raise exception.BadRequest(_("Error loading user: %(e)s")
                                            % {'e': e})
             if not user:
-                raise exception.UserNotFound(uuid=id)
+                raise exception.UserNotFound(uuid=identity.id)
             try:
-                models.User.update_attributes(context, instance_id, username,
-                                              hostname, user_attrs)
+                models.User.update_attributes(context, instance_id,
+                                              identity.name, identity.host,
+                                              user_attrs)
             except (ValueError, AttributeError) as e:
                 raise exception.BadRequest(_("User update error: %(e)s")
                                            % {'e': e})
@@ -261,17 +287,19 @@ class UserController(ExtensionController):
                     mu = guest_models.K2hdkcUser(name=user['name'],
                                                 host=user.get('host'),
                                                 password=user['password'])
-                    found_user = models.User.load(context, instance_id,
-                                                  mu.name, mu.host)
-                    if not found_user:
-                        user_and_host = mu.name
-                        if mu.host:
-                            user_and_host += '@' + mu.host
-                        raise exception.UserNotFound(uuid=user_and_host)
+                    mu.check_reserved()
                     model_users.append(mu)
                 except (ValueError, AttributeError) as e:
                     raise exception.BadRequest(_("Error loading user: %(e)s")
                                                % {'e': e})
+            # Verify all users with one listing and report all missing
+            # users at once.
+            missing_users = models.User.find_missing(context, instance_id,
+                                                     model_users)
+            if missing_users:
+                raise exception.UserNotFound(uuid=", ".join(
+                    mu.name + ('@' + mu.host if mu.host else '')
+                    for mu in missing_users))
             try:
                 models.User.change_password(context, instance_id, model_users)
             except (ValueError, AttributeError) as e:
@@ -292,15 +320,14 @@ class UserAccessController(ExtensionController):
             schema = cls.schemas.get(action).get('databases')
         return schema
 
-    def _get_user(self, context, instance_id, user_id):
-        username, hostname = unquote_user_host(user_id)
+    def _get_user(self, context, instance_id, identity):
         try:
-            user = models.User.load(context, instance_id, username, hostname)
+            user = identity.load(context, instance_id)
         except (ValueError, AttributeError) as e:
             raise exception.BadRequest(_("Error loading user: %(e)s")
                                        % {'e': e})
         if not user:
-            raise exception.UserNotFound(uuid=user_id)
+            raise exception.UserNotFound(uuid=identity.id)
         return user
 
     def index(self, req, tenant_id, instance_id, user_id):
@@ -313,14 +340,11 @@ class UserAccessController(ExtensionController):
         self.authorize_target_action(
             context, 'user_access:index', instance_id)
         # Make sure this user exists.
-        user_id = correct_id_with_req(user_id, req)
-        user = self._get_user(context, instance_id, user_id)
-        if not user:
-            LOG.error("No such user: %(user)s ", {'user': user})
-            raise exception.UserNotFound(uuid=user)
-        username, hostname = unquote_user_host(user_id)
-        access = models.User.access(context, instance_id, username, hostname)
-        view = views.UserAccessView(access.databases)
+        identity = UserIdentity(req, user_id)
+        self._get_user(context, instance_id, identity)
+        access = models.User.access(context, instance_id, identity.name,
+                                    identity.host)
+        view = views.UserAccessView(access)
         return wsgi.Result(view.data(), 200)
 
     def update(self, req, body, tenant_id, instance_id, user_id):
@@ -333,17 +357,13 @@ class UserAccessController(ExtensionController):
             context, 'user_access:update', instance_id)
         context.notification = notification.DBaaSUserGrant(
             context, request=req)
-        user_id = correct_id_with_req(user_id, req)
-        user = self._get_user(context, instance_id, user_id)
-        if not user:
-            LOG.error("No such user: %(user)s ", {'user': user})
-            raise exception.UserNotFound(uuid=user)
-        username, hostname = unquote_user_host(user_id)
+        identity = UserIdentity(req, user_id)
+        self._get_user(context, instance_id, identity)
         databases = [db['name'] for db in body['databases']]
         with StartNotification(context, instance_id=instance_id,
-                               username=username, database=databases):
-            models.User.grant(context, instance_id, username, hostname,
-                              databases)
+                               username=identity.name, database=databases):
+            models.User.grant(context, instance_id, identity.name,
+                              identity.host, databases)
         return wsgi.Result(None, 202)
 
     def delete(self, req, tenant_id, instance_id, user_id, id):
@@ -356,19 +376,17 @@ class UserAccessController(ExtensionController):
             context, 'user_access:delete', instance_id)
         context.notification = notification.DBaaSUserRevoke(
             context, request=req)
-        user_id = correct_id_with_req(user_id, req)
-        user = self._get_user(context, instance_id, user_id)
-        if not user:
-            LOG.error("No such user: %(user)s ", {'user': user})
-            raise exception.UserNotFound(uuid=user)
-        username, hostname = unquote_user_host(user_id)
-        access = models.User.access(context, instance_id, username, hostname)
+        identity = UserIdentity(req, user_id)
+        self._get_user(context, instance_id, identity)
+        access = models.User.access(context, instance_id, identity.name,
+                                    identity.host)
         databases = [db.name for db in access.databases]
         with StartNotification(context, instance_id=instance_id,
-                               username=username, database=databases):
+                               username=identity.name, database=databases):
             if id not in databases:
                 raise exception.DatabaseNotFound(uuid=id)
-            models.User.revoke(context, instance_id, username, hostname, id)
+            models.User.revoke(context, instance_id, identity.name,
+                               identity.host, id)
         return wsgi.Result(None, 202)
 
 
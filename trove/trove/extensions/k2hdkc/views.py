@@ -20,35 +20,25 @@ class UserView(object):
         self.user = user
 
     def data(self):
-        user_dict = {
-            "name": self.user.name,
-            "host": self.user.host,
-            "databases": self.user.databases
-        }
-        return {"user": user_dict}
+        return {"user": self.user.view_data()}
 
 
 class UsersView(object):
 
     def __init__(self, users):
+        # These are view-ready dicts from Users.load
         self.users = users
 
     def data(self):
-        userlist = [{"name": user.name,
-                     "host": user.host,
-                     "databases": user.databases}
-                    for user in self.users]
-
-        return {"users": userlist}
+        return {"users": list(self.users)}
 
 
 class UserAccessView(object):
-    def __init__(self, databases):
-        self.databases = databases
+    def __init__(self, access):
+        self.access = access
 
     def data(self):
-        dbs = [{"name": db.name} for db in self.databases]
-        return {"databases": dbs}
+        return self.access.view_data()
 
 
 class SchemaView(object):
@@ -57,18 +47,14 @@ class SchemaView(object):
         self.schema = schema
 
     def data(self):
-        return {"name": self.schema.name}
+        return self.schema.view_data()
 
 
 class SchemasView(object):
 
     def __init__(self, schemas):
+        # These are view-ready dicts from Schemas.load
         self.schemas = schemas
 
     def data(self):
-        data = []
-        # These are model instances
-        for schema in self.schemas:
-            data.append(SchemaView(schema).data())
-
-        return {"databases": data}
+        return {"databases": list(self.schemas)}
@@ -28,10 +28,13 @@ from trove.guestagent.datastore import manager
 from trove.guestagent.datastore.experimental.k2hdkc import service
 from trove.guestagent.common import operating_system
 from trove.guestagent.utils import docker as docker_util
+from trove.guestagent.utils import k2hdkc as k2hdkc_util
 from trove.guestagent import volume
 from trove.instance import service_status
 from trove.instance.service_status import ServiceStatuses
 from trove.common.notification import EndNotification
+import functools
+import json
 import os.path
 from pathlib import Path
 
@@ -40,6 +43,33 @@ K2HDKC_MANAGER = 'k2hdkc'
 LOG = logging.getLogger(__name__)
 SERVICE_STATUS_TIMEOUT = 60
 K2HDKC_CONFIG_PARAM_DIR = '/etc/antpickax'
+K2HDKC_VALIDATION_RULES = 'k2hdkc/validation-rules.json'
+
+# [NOTE]
+# The parameters with "k2hdkc_apply" in validation-rules.json are put
+# into files in K2HDKC_CONFIG_PARAM_DIR, which k2hdkc-trove reads.
+# "restart" means k2hdkc-trove must be restarted to use a new value.
+# "reload" means CHMPX is reloaded in the running container, see
+# K2hdkcApp.reload_chmpx.
+#
+K2HDKC_APPLY_KEY = 'k2hdkc_apply'
+K2HDKC_APPLY_RESTART = 'restart'
+K2HDKC_APPLY_RELOAD = 'reload'
+
+
+@functools.lru_cache(maxsize=None)
+def _load_override_rules():
+    """Returns {parameter name: apply method} of the key file parameters.
+
+    validation-rules.json is found as the other templates are, and is
+    parsed once per process.
+    """
+    source, _filename, _uptodate = utils.ENV.loader.get_source(
+        utils.ENV, K2HDKC_VALIDATION_RULES)
+    rules = json.loads(source)
+    return dict((param['name'], param[K2HDKC_APPLY_KEY])
+                for param in rules['configuration-parameters']
+                if K2HDKC_APPLY_KEY in param)
 
 
 class Manager(manager.Manager):
@@ -138,6 +168,7 @@ class Manager(manager.Manager):
             except Exception:
                 LOG.exception("Failed to start k2hdkc")
                 raise exception.TroveError("Failed to start k2hdkc")
+            self.status.invalidate_status_cache()
 
             if not self.status.wait_for_status(
                 service_status.ServiceStatuses.HEALTHY,
@@ -176,71 +207,92 @@ class Manager(manager.Manager):
         require restart, so this is a no-op.
         """
 
-    def _create_k2hdkc_key_files(self, key, empty_is_changed=False):
-        """Detects the key from the overrides.
-        Returns true if the key exists in the overrides. false otherwise.
-        Returns true if the empty_is_changed is true and the key is null.
+    def get_reload_status(self, context):
+        """Returns the parameters and the downtime in seconds of the last
+        CHMPX reload of this node, None if CHMPX has not been reloaded.
         """
-        result = False
-        file_path = K2HDKC_CONFIG_PARAM_DIR + '/' + key
-        value = self.app.get_value(key)
-
-        current_param_value = None
-        file_exist = False
-        if os.path.isfile(file_path):
-            file_exist = True
-            with open(file_path, 'r') as override_param_file:
-                current_param_value = override_param_file.read().replace(
-                    '\n', '')
-                if not current_param_value or len(current_param_value) == 0:
-                    current_param_value = None
-
-        if not value:
-            if not current_param_value:
-                if empty_is_changed:
-                    result = True
-            else:
-                result = True
-
-            # Remove file
-            if file_exist:
+        return self.app.last_reload
+
+    def service_out(self, context):
+        """Services out this node before it is removed from the cluster."""
+        LOG.info("Servicing out this node.")
+        self.app.service_out()
+
+    def get_chmpx_status(self, context):
+        """Returns the CHMPX status of this node as a dict."""
+        return k2hdkc_util.probe_node_status().serialize()
+
+    def _read_k2hdkc_key_file(self, key):
+        """Returns the value in the key file, None if it is not set."""
+        file_path = os.path.join(K2HDKC_CONFIG_PARAM_DIR, key)
+        if not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'r') as override_param_file:
+            return override_param_file.read().replace('\n', '') or None
+
+    def _write_k2hdkc_key_file(self, key, value):
+        """Replaces the key file atomically, removes it if value is None."""
+        file_path = os.path.join(K2HDKC_CONFIG_PARAM_DIR, key)
+        if value is None:
+            if os.path.isfile(file_path):
                 os.remove(file_path)
+            return
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w') as override_param_file:
+            override_param_file.write(value)
+        os.replace(tmp_path, file_path)
 
-        else:
-            if value != current_param_value:
-                result = True
-
-            # Update file
-            with open(file_path, 'w') as override_param_file:
-                override_param_file.write(str(value))
+    def _diff_k2hdkc_overrides(self):
+        """Returns {key: value} of the key files to change.
 
-        return result
+        The configuration is parsed once. None means the file is removed.
+        """
+        values = self.app.get_values()
+        changes = {}
+        for key in _load_override_rules():
+            value = values.get(key)
+            value = str(value) if value not in (None, '') else None
+            if value != self._read_k2hdkc_key_file(key):
+                changes[key] = value
+        return changes
 
     #
     # Here, the parameters are output to a file.
     # Therefore, Docker should mount the directory of this file, so you shouldn't have to do anything!
     #
     def _create_k2hdkc_overrides_files(self):
-        """puts values to files in /etc/antpickax.
-        """
-        is_changed = False
-
-        if self._create_k2hdkc_key_files('cluster-name', True):
-            is_changed = True
-
-        if self._create_k2hdkc_key_files('extdata-url', True):
-            is_changed = True
-
-        if self._create_k2hdkc_key_files('chmpx-server-port', True):
-            is_changed = True
+        """puts changed values to files in /etc/antpickax.
 
-        if self._create_k2hdkc_key_files('chmpx-server-ctlport', True):
-            is_changed = True
-
-        if self._create_k2hdkc_key_files('chmpx-slave-ctlport', True):
-            is_changed = True
-
-        if is_changed:
+        k2hdkc-trove is restarted only if a changed parameter needs it.
+        The changes which CHMPX can reload are applied without restart.
+        """
+        changes = self._diff_k2hdkc_overrides()
+        if not changes:
+            LOG.debug("No k2hdkc override is changed.")
+            return
+
+        # The control port before the changes, to service out this node.
+        ctlport = k2hdkc_util.get_ctlport()
+        for key, value in changes.items():
+            self._write_k2hdkc_key_file(key, value)
+        LOG.info("Changed k2hdkc overrides: %s", ', '.join(sorted(changes)))
+
+        rules = _load_override_rules()
+        applies = set(rules[key] for key in changes)
+        if K2HDKC_APPLY_RELOAD in applies:
+            if K2HDKC_APPLY_RESTART in applies or None in changes.values():
+                # The restart applies all changes, and a removed value can
+                # not be reloaded.
+                applies.add(K2HDKC_APPLY_RESTART)
+            else:
+                try:
+                    self.app.reload_chmpx(changes, ctlport)
+                    return
+                except Exception:
+                    LOG.exception("Failed to reload CHMPX, restart k2hdkc.")
+                    applies.add(K2HDKC_APPLY_RESTART)
+
+        if K2HDKC_APPLY_RESTART in applies:
             try:
                 utils.execute_with_timeout(
                     "/bin/sudo /usr/bin/systemctl restart k2hdkc-trove",
@@ -261,8 +313,7 @@ class Manager(manager.Manager):
     #################
     def restart(self, context):
         """MUST be implemented."""
-        self.status.restart_db_service(service.K2HDKC_SERVICE,
-                                       self._service_status_timeout)
+        self.app.restart()
 
     def stop_db(self, context, do_not_start_on_reboot=False):
         """Stop the database server.
@@ -303,7 +354,16 @@ class Manager(manager.Manager):
                 "/var/lib/antpickax/k2hdkc": {"bind": "/var/lib/antpickax/k2hdkc", "mode": "rw", "driver": "local"},
             }
 
-            extra_params = ""
+            backup_info = dict(backup_info)
+            backup_info['storage_driver'] = self.app.get_backup_storage_driver(
+                backup_info.get('storage_driver', CONF.storage_strategy))
+            self.app.check_backup_storage_driver(
+                backup_info['storage_driver'])
+            extra_params = (
+                f"--k2hdkc-codec={CONF.k2hdkc.backup_codec} "
+                f"--k2hdkc-codec-threads={CONF.k2hdkc.backup_codec_threads} "
+                f"{self.app.get_backup_storage_params()} "
+                f"{self.app.get_backup_command_params()}")
             self.app.create_backup(context, backup_info,
                 volumes_mapping=volumes, need_dbuser=False,
                 extra_params=extra_params)
@@ -19,7 +19,10 @@
 #
 
 import docker
+import re
 import shlex
+import threading
+import time
 from oslo_log import log as logging
 from trove.common import cfg
 from trove.common import exception
@@ -30,6 +33,7 @@ from trove.guestagent.common.configuration import ConfigurationManager
 from trove.guestagent.datastore import service
 from trove.guestagent.common import guestagent_utils
 from trove.guestagent.utils import docker as docker_util
+from trove.guestagent.utils import k2hdkc as k2hdkc_util
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
@@ -37,6 +41,18 @@ SERVER_INI = '/etc/antpickax/server.ini'
 K2HDKC_TROVE_INI = '/etc/antpickax/k2hdkc-trove.cfg'
 K2HDKC_SERVICE = ['k2hdkc-trove']
 K2HDKC_DATA_DIR = '/var/lib/antpickax/k2hdkc'
+K2HDKC_CONTAINER_NAME = 'database'
+RESTORE_PROGRESS_RE = re.compile(r'Restore (progress|pipeline finished)')
+RESTORE_SUCCESS_MSG = 'Restore successfully'
+RESTORE_OUTPUT_LINES = 20
+DOCKER_EVENTS_RETRY_INTERVAL = 5
+CHMPX_SERVICEOUT_POLL_INTERVAL = 2
+# [NOTE]
+# The swift storage driver of trove does not save the metadata of a
+# backup larger than one segment, so its restore falls back to "tar xz".
+# Only the codecs which produce a gzip stream can be used with it.
+#
+SWIFT_BACKUP_CODECS = ('gzip', 'pigz')
 
 # [TODO]
 # At this time, the guest operating system only supports CentOS.
@@ -68,6 +84,7 @@ class K2hdkcApp(service.BaseDbApp):
                           line_terminator='\n'),
             requires_root=True))
         self.state_change_wait_time = CONF.state_change_wait_time
+        self.last_reload = None
 
     def update_overrides(self, context, overrides, remove=False):
         """ invokes the configuration_manager.apply_user_override() """
@@ -85,6 +102,10 @@ class K2hdkcApp(service.BaseDbApp):
         """ returns the k2hdkc configuration_manager """
         return self.configuration_manager.get_value(key)
 
+    def get_values(self):
+        """ returns all values of the k2hdkc configuration, parsed once """
+        return self.configuration_manager.parse_configuration()
+
     @property
     def k2hdkc_data_dir(self):
         """ returns the k2hdkc data directory """
@@ -96,6 +117,121 @@ class K2hdkcApp(service.BaseDbApp):
         """ returns the k2hdkc list """
         return ['k2hdkc-trove']
 
+    def get_backup_storage_driver(self, storage_driver):
+        """ returns the storage driver of the backup container """
+        if storage_driver == 'swift':
+            return CONF.k2hdkc.backup_storage_driver
+        return storage_driver
+
+    def check_backup_storage_driver(self, storage_driver):
+        """ raises an error if the backup could not be restored from the
+        storage driver with the backup codec and stream configuration
+        """
+        if storage_driver != 'swift':
+            return
+        if CONF.k2hdkc.backup_codec not in SWIFT_BACKUP_CODECS:
+            raise exception.TroveError(
+                f"The backup codec {CONF.k2hdkc.backup_codec} can not be "
+                f"used with the swift backup storage driver, use one of "
+                f"{', '.join(SWIFT_BACKUP_CODECS)} or k2hdkc_swift.")
+        if CONF.k2hdkc.backup_stream:
+            raise exception.TroveError(
+                "The backup stream mode can not be used with the swift "
+                "backup storage driver, use k2hdkc_swift.")
+
+    def get_backup_storage_params(self):
+        """ returns the parameters of the k2hdkc_swift storage driver """
+        return (f"--k2hdkc-segment-size={CONF.k2hdkc.backup_segment_size} "
+                f"--k2hdkc-segment-concurrency="
+                f"{CONF.k2hdkc.backup_segment_concurrency}")
+
+    def get_backup_command_params(self):
+        """ returns the parameters of the k2hash archive commands """
+        return (f"--k2hdkc-command-timeout="
+                f"{CONF.k2hdkc.backup_command_timeout} "
+                f"--k2hdkc-min-throughput="
+                f"{CONF.k2hdkc.backup_min_throughput} "
+                f"--{'' if CONF.k2hdkc.backup_stream else 'no'}k2hdkc-stream "
+                f"--k2hdkc-pipeline-buffer="
+                f"{CONF.k2hdkc.restore_pipeline_buffer}")
+
+    def reload_chmpx(self, changes, ctlport):
+        """ applies CHMPX port and cluster changes without restarting
+        k2hdkc-trove, and returns the downtime of this node in seconds.
+
+        This node is serviced out and the merging is waited on ctlport,
+        which is the control port before the changes. Then the container
+        registers this node again and relaunches CHMPX and K2HDKC with the
+        new parameters, and services this node in.
+        """
+        started = time.monotonic()
+        self.service_out()
+        self._wait_for_serviceout(ctlport, started)
+
+        params = ' '.join('%s=%s' % (key, changes[key])
+                          for key in sorted(changes))
+        docker_util.run_command(
+            self.docker_client,
+            '/bin/sh -c "/usr/libexec/k2hdkctrove.sh reload %s"' % params)
+        self.status.invalidate_status_cache()
+        if not self.status.wait_for_status(
+                service_status.ServiceStatuses.HEALTHY,
+                self.state_change_wait_time, False):
+            raise exception.TroveError(
+                "k2hdkc did not become HEALTHY after reloading CHMPX")
+
+        downtime = time.monotonic() - started
+        self.last_reload = {'parameters': sorted(changes),
+                            'downtime': downtime}
+        LOG.info("Reloaded CHMPX with %(params)s, downtime of this node: "
+                 "%(downtime).1f seconds",
+                 {'params': params, 'downtime': downtime})
+        return downtime
+
+    def service_out(self):
+        """ services out this node, CHMPX moves the data of this node to
+        the other nodes.
+        """
+        docker_util.run_command(
+            self.docker_client,
+            '/bin/sh -c "/usr/libexec/k2hdkctrove.sh serviceout"')
+        self.status.invalidate_status_cache()
+
+    def _wait_for_serviceout(self, ctlport, started):
+        """ waits until this node is out of service and nothing is merging
+
+        Raises TroveError on timeout, because unregistering a node which is
+        still merging loses its keys.
+        """
+        while time.monotonic() - started < self.state_change_wait_time:
+            try:
+                node_status = k2hdkc_util.probe_node_status(ctlport)
+                if not node_status.service_in and not node_status.merging:
+                    return
+            except k2hdkc_util.ChmpxProbeError as exc:
+                LOG.debug("CHMPX probe failed while servicing out(%s)", exc)
+            time.sleep(CHMPX_SERVICEOUT_POLL_INTERVAL)
+        raise exception.TroveError(
+            "Merging after service out is not finished in %s seconds, "
+            "CHMPX is not reloaded." % self.state_change_wait_time)
+
+    def restart(self):
+        """ restarts the k2hdkc container and waits until it is HEALTHY
+        """
+        LOG.info("Restarting k2hdkc")
+        try:
+            docker_util.restart_container(self.docker_client)
+        except Exception:
+            LOG.exception("Failed to restart k2hdkc")
+            raise exception.TroveError("Failed to restart k2hdkc")
+        finally:
+            self.status.invalidate_status_cache()
+
+        if not self.status.wait_for_status(
+                service_status.ServiceStatuses.HEALTHY,
+                self.state_change_wait_time, update_db=True):
+            raise exception.TroveError("Failed to start k2hdkc")
+
     def stop_db(self, update_db=False, do_not_start_on_reboot=False):
         """ stops k2hdkc database """
         cmd = '/bin/sh -c "/usr/libexec/k2hdkctrove.sh stop"'
@@ -103,6 +239,7 @@ class K2hdkcApp(service.BaseDbApp):
             docker_util.run_command(self.docker_client, cmd)
         except Exception as exc:
             LOG.warning('Could not stop databse and unregister node.')
+        self._status.invalidate_status_cache()
 
     def restore_backup_k2hdkc(self, context, restore_location, backup_info, overrides):
         LOG.debug("restore_backup - called")
@@ -111,7 +248,8 @@ class K2hdkcApp(service.BaseDbApp):
         backup_id = backup_info.get('id')
 
         # 2. storage_driver
-        qstr_storage_driver = shlex.quote(CONF.storage_strategy)
+        qstr_storage_driver = shlex.quote(
+            self.get_backup_storage_driver(CONF.storage_strategy))
 
         # 3. backup_driver
         qstr_backup_driver = shlex.quote(cfg.get_configuration_property('backup_strategy'))
@@ -169,7 +307,9 @@ class K2hdkcApp(service.BaseDbApp):
             f'{os_cred} '
             f'--restore-from={qstr_backup_info_location} '
             f'--restore-checksum={qstr_backup_info_checksum} '
-            f'--db-datadir {qstr_restore_location}'
+            f'--db-datadir {qstr_restore_location} '
+            f'{self.get_backup_storage_params()} '
+            f'{self.get_backup_command_params()}'
         )
         if CONF.backup_aes_cbc_key:
             command = (f"{command} "
@@ -221,7 +361,25 @@ class K2hdkcApp(service.BaseDbApp):
             output = err.container.logs()
             return output, False
 
-        return output, True
+        return self._follow_restore_container(output)
+
+    def _follow_restore_container(self, container):
+        """ waits for the restore container and logs its progress """
+        lines = []
+        for chunk in container.logs(stream=True, follow=True):
+            for line in chunk.decode(errors='replace').splitlines():
+                if RESTORE_PROGRESS_RE.search(line):
+                    LOG.info(f"{container.name}: {line}")
+                lines.append(line)
+            del lines[:-RESTORE_OUTPUT_LINES]
+
+        status_code = container.wait().get('StatusCode')
+        success = (status_code == 0 and
+                   any(RESTORE_SUCCESS_MSG in line for line in lines))
+        if not success:
+            LOG.error(f"Failed to restore, status code: {status_code}, "
+                      f"output: {lines}")
+        return lines, success
 
 
 class K2hdkcAppStatus(service.BaseDbStatus):  # pylint: disable=too-few-public-methods
@@ -232,21 +390,97 @@ class K2hdkcAppStatus(service.BaseDbStatus):  # pylint: disable=too-few-public-m
         LOG.debug("K2hdkcAppStatus::__init__")
         super().__init__(docker_client)
 
+        # [NOTE]
+        # The actual status is cached for k2hdkc.status_cache_ttl seconds.
+        # The cache is dropped as soon as the docker events stream reports
+        # any event of the database container. wait_for_status does not use
+        # the cache, because its consecutive HEALTHY checks must be new
+        # observations and CHMPX ring changes make no docker events.
+        #
+        self._status_cache_ttl = CONF.k2hdkc.status_cache_ttl
+        self._status_cache = None
+        self._status_cache_time = 0
+        self._status_cache_generation = 0
+        self._status_cache_lock = threading.Lock()
+        self._status_uncached = threading.local()
+        self._events_watcher = None
+
+    def invalidate_status_cache(self):
+        """ drops the cached actual status """
+        with self._status_cache_lock:
+            self._status_cache = None
+            self._status_cache_time = 0
+            self._status_cache_generation += 1
+
+    def _start_events_watcher(self):
+        """ starts the thread which subscribes the docker events stream """
+        if self._events_watcher and self._events_watcher.is_alive():
+            return
+        self._events_watcher = threading.Thread(
+            target=self._watch_container_events,
+            name='k2hdkc-docker-events',
+            daemon=True)
+        self._events_watcher.start()
+
+    def _watch_container_events(self):
+        filters = {'type': 'container', 'container': K2HDKC_CONTAINER_NAME}
+        while True:
+            try:
+                for event in self.docker_client.events(decode=True,
+                                                       filters=filters):
+                    LOG.debug("Docker event for %s: %s",
+                              K2HDKC_CONTAINER_NAME, event.get('status'))
+                    self.invalidate_status_cache()
+            except Exception as exc:
+                LOG.warning("Docker events stream is disconnected(%s), "
+                            "retry after %s seconds.", exc,
+                            DOCKER_EVENTS_RETRY_INTERVAL)
+            # The events may be lost while disconnected.
+            self.invalidate_status_cache()
+            time.sleep(DOCKER_EVENTS_RETRY_INTERVAL)
+
+    def wait_for_status(self, status, max_time, update_db=False):
+        """ waits for the status without the status cache """
+        self._status_uncached.enabled = True
+        try:
+            return super().wait_for_status(status, max_time, update_db)
+        finally:
+            self._status_uncached.enabled = False
+
     def get_actual_db_status(self):  # pylint: disable=no-self-use
         """ It is called from wait_for_real_status_to_change_to of BaseDbStatus class.
         """
+        if (self._status_cache_ttl <= 0 or
+                getattr(self._status_uncached, 'enabled', False)):
+            return self._get_actual_db_status()
+
+        self._start_events_watcher()
+        with self._status_cache_lock:
+            if (self._status_cache is not None and
+                    time.monotonic() - self._status_cache_time <
+                    self._status_cache_ttl):
+                LOG.debug("K2hdkcAppStatus::get_actual_db_status from cache")
+                return self._status_cache
+            generation = self._status_cache_generation
+
+        status = self._get_actual_db_status()
+        with self._status_cache_lock:
+            # Do not cache the status if an event came while getting it.
+            if generation == self._status_cache_generation:
+                self._status_cache = status
+                self._status_cache_time = time.monotonic()
+        return status
+
+    def _get_actual_db_status(self):
+        """ Gets the actual status from docker and chmpx without cache. """
         status = docker_util.get_container_status(self.docker_client)
         LOG.debug("K2hdkcAppStatus::_get_actual_db_status")
         if status == "running":
-            cmd = '/bin/sh -c "/usr/libexec/k2hdkctrove.sh status"'
-            container_status = docker_util.run_command(self.docker_client, cmd)
-            LOG.debug("Get Container Status: {}".format(container_status.decode()))
-
-            if "HEALTHY" in container_status.decode():
+            if self._is_k2hdkc_healthy():
                 LOG.debug('Container status result is HEALTHY, so status is HEALTHY')
                 return service_status.ServiceStatuses.HEALTHY
             else:
-                LOG.debug('Container status result is %s (not including HEALTHY), so status is RUNNING', container_status)
+                LOG.debug('Container status result is not HEALTHY, so status is RUNNING')
                 return service_status.ServiceStatuses.RUNNING
 
         elif status == "not running":
@@ -260,6 +494,21 @@ class K2hdkcAppStatus(service.BaseDbStatus):  # pylint: disable=too-few-public-m
         else:
             return service_status.ServiceStatuses.UNKNOWN
 
+    def _is_k2hdkc_healthy(self):
+        """ Asks the CHMPX control port for the node status, and falls back
+        to 'k2hdkctrove.sh status' in the container only if it fails.
+        """
+        try:
+            node_status = k2hdkc_util.probe_node_status()
+            return node_status.healthy
+        except k2hdkc_util.ChmpxProbeError as exc:
+            LOG.debug("CHMPX probe failed(%s), so try status command.", exc)
+
+        cmd = '/bin/sh -c "/usr/libexec/k2hdkctrove.sh status"'
+        container_status = docker_util.run_command(self.docker_client, cmd)
+        LOG.debug("Get Container Status: {}".format(container_status.decode()))
+        return "HEALTHY" in container_status.decode()
+
 #
 # Local variables:
 # tab-width: 4
@@ -1 +1,223 @@
-### Not implement yet
+# -*- coding: utf-8 -*-
+#
+# K2HDKC DBaaS based on Trove
+#
+# Copyright 2020 Yahoo Japan Corporation
+#
+# K2HDKC DBaaS is a Database as a Service compatible with Trove which
+# is DBaaS for OpenStack.
+# Using K2HR3 as backend and incorporating it into Trove to provide
+# DBaaS functionality. K2HDKC, K2HR3, CHMPX and K2HASH are components
+# provided as AntPickax.
+#
+# For the full copyright and license information, please view
+# the license file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Sun, Oct 18 2026
+# REVISION:
+#
+"""CHMPX node probe for the k2hdkc guest agent.
+
+The k2hdkc container runs in the 'host' network mode, so the CHMPX
+control port is reachable from the guest agent directly. This module
+talks to that port instead of running chmpxstatus inside the container.
+"""
+
+import os.path
+import re
+import socket
+import time
+
+from oslo_log import log as logging
+from trove.common import cfg
+from trove.common import exception
+from trove.common.i18n import _
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+CHMPX_CTL_HOST = '127.0.0.1'
+CHMPX_CTLPORT_FILE = '/etc/antpickax/chmpx-server-ctlport'
+CHMPX_CTL_TIMEOUT = 1
+CHMPX_CTL_BUFSIZE = 4096
+
+CHMPX_CMD_SELFSTATUS = 'SELFSTATUS'
+
+# [NOTE]
+# The status line of CHMPX is printed as a list of bracketed fields,
+# for example "[SERVICE IN][UP][n/a][Nothing][NoSuspend]".
+# The order is ring, live, pending(add/delete), merge and suspend.
+#
+CHMPX_STATUS_FIELDS_RE = re.compile(r'\[([^\[\]]+)\]')
+CHMPX_RING_SERVICE_IN = 'SERVICE IN'
+CHMPX_RING_SERVICE_OUT = 'SERVICE OUT'
+CHMPX_LIVE_UP = 'UP'
+CHMPX_LIVE_DOWN = 'DOWN'
+CHMPX_SUSPEND = 'Suspend'
+CHMPX_NOSUSPEND = 'NoSuspend'
+CHMPX_MERGE_NOTHING = 'Nothing'
+CHMPX_PENDING_NONE = 'n/a'
+
+
+class ChmpxProbeError(exception.TroveError):
+
+    message = _("Could not probe CHMPX node status: %(reason)s")
+
+
+class ChmpxNodeStatus(object):
+    """Structured status of the CHMPX server node on this guest."""
+
+    def __init__(self, ring, live, pending=None, merge=None, suspend=None):
+        self.ring = ring
+        self.live = live
+        self.pending = pending
+        self.merge = merge
+        self.suspend = suspend
+
+    @property
+    def service_in(self):
+        return self.ring == CHMPX_RING_SERVICE_IN
+
+    @property
+    def up(self):
+        return self.live == CHMPX_LIVE_UP
+
+    @property
+    def suspended(self):
+        return self.suspend == CHMPX_SUSPEND
+
+    @property
+    def merging(self):
+        """Returns true if data merging or add/delete is not finished."""
+        return ((self.merge is not None and
+                 self.merge != CHMPX_MERGE_NOTHING) or
+                (self.pending is not None and
+                 self.pending != CHMPX_PENDING_NONE))
+
+    @property
+    def healthy(self):
+        """Same condition as 'k2hdkctrove.sh status' reports HEALTHY.
+
+        The suspend field must be NoSuspend, a missing field is not healthy.
+        """
+        return (self.service_in and self.up and
+                self.suspend == CHMPX_NOSUSPEND)
+
+    def serialize(self):
+        """Returns the status as a dict which can be sent by RPC."""
+        return {'ring': self.ring,
+                'live': self.live,
+                'pending': self.pending,
+                'merge': self.merge,
+                'suspend': self.suspend,
+                'service_in': self.service_in,
+                'merging': self.merging,
+                'suspended': self.suspended}
+
+    def __repr__(self):
+        return ("ChmpxNodeStatus(ring=%s, live=%s, pending=%s, merge=%s, "
+                "suspend=%s)" % (self.ring, self.live, self.pending,
+                                 self.merge, self.suspend))
+
+
+def get_ctlport():
+    """Returns the CHMPX server control port of this node.
+
+    The port in the overrides file(written by the guest manager) has
+    priority over the k2hdkc.ctrl_port configuration.
+    """
+    if os.path.isfile(CHMPX_CTLPORT_FILE):
+        try:
+            with open(CHMPX_CTLPORT_FILE, 'r') as ctlport_file:
+                value = ctlport_file.read().strip()
+            if value:
+                return int(value)
+        except (IOError, ValueError) as exc:
+            LOG.debug("Could not read %s: %s", CHMPX_CTLPORT_FILE, exc)
+    return CONF.k2hdkc.ctrl_port
+
+
+def _decode_response(chunks):
+    return b''.join(chunks).rstrip(b'\0').decode(errors='replace')
+
+
+def send_command(command, port=None, host=CHMPX_CTL_HOST,
+                 timeout=CHMPX_CTL_TIMEOUT, complete=None):
+    """Sends one control command to CHMPX and returns the response.
+
+    The command is sent with a newline as 'echo <command> | curl' does.
+    The response is read until CHMPX closes the connection, sends a NUL,
+    or complete(response) returns true. If the timeout expires after
+    a complete response was received, the response is returned.
+    """
+    if port is None:
+        port = get_ctlport()
+    chunks = []
+    deadline = time.monotonic() + timeout
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(command.encode() + b'\n')
+            while True:
+                sock.settimeout(max(deadline - time.monotonic(), 0.01))
+                chunk = sock.recv(CHMPX_CTL_BUFSIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if chunk.endswith(b'\0'):
+                    break
+                if complete and complete(_decode_response(chunks)):
+                    break
+    except (OSError, socket.timeout) as exc:
+        if chunks and complete and complete(_decode_response(chunks)):
+            return _decode_response(chunks)
+        raise ChmpxProbeError(reason="%s to %s:%s failed(%s)" % (
+            command, host, port, exc))
+    return _decode_response(chunks)
+
+
+def parse_node_status(output):
+    """Parses the status line from SELFSTATUS(or chmpxstatus -self)."""
+    for line in output.splitlines():
+        if ('[' + CHMPX_RING_SERVICE_IN + ']' not in line and
+                '[' + CHMPX_RING_SERVICE_OUT + ']' not in line):
+            continue
+        fields = CHMPX_STATUS_FIELDS_RE.findall(line)
+        fields = fields[fields.index(CHMPX_RING_SERVICE_IN)
+                        if CHMPX_RING_SERVICE_IN in fields
+                        else fields.index(CHMPX_RING_SERVICE_OUT):]
+        if len(fields) < 2:
+            break
+        fields += [None] * (5 - len(fields))
+        return ChmpxNodeStatus(*fields[:5])
+    raise ChmpxProbeError(reason="no status line in the CHMPX response")
+
+
+def has_node_status(output):
+    """Returns true if the output has a whole status line."""
+    try:
+        parse_node_status(output[:output.rfind('\n') + 1])
+    except ChmpxProbeError:
+        return False
+    return True
+
+
+def probe_node_status(port=None):
+    """Returns the ChmpxNodeStatus of this node.
+
+    Raises ChmpxProbeError when CHMPX is not reachable or the response
+    could not be parsed.
+    """
+    status = parse_node_status(send_command(CHMPX_CMD_SELFSTATUS, port,
+                                            complete=has_node_status))
+    LOG.debug("CHMPX node status: %s", status)
+    return status
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: expandtab sw=4 ts=4 fdm=marker
+# vim<600: expandtab sw=4 ts=4
+#